@@ -51,6 +51,7 @@ _git_hub() {
         set-origin
         setup-goblet
         status
+        sync
         unprotect
         whoami
         whois
@@ -98,6 +99,7 @@ _git_lab() {
         repos
         set-origin
         setup-goblet
+        sync
         unprotect
         whoami
         whois
@@ -148,6 +150,7 @@ _git_bb() {
         setup-goblet
         snippet
         snippets
+        sync
         whoami
         whois
     "
@@ -199,6 +202,7 @@ __git_spindle() {
         --file
         --template
         --reuse-message
+        --search
         # valued git clone options
         --reference
         --reference-if-able
@@ -643,7 +647,9 @@ _git_spindle_issue() {
 }
 
 _git_spindle_issues() {
-    __git_spindle_options "--parent" && return
+    [ "$prev" = "--search" ] && unset COMPREPLY && return
+    __git_spindle_options "--search=" no_space
+    __git_spindle_options "--parent --cached" && return
 
     case $1,${#previous_args[@]} in
         hub,*)
@@ -1000,7 +1006,7 @@ _git_spindle_render() {
 }
 
 _git_spindle_repos() {
-    __git_spindle_options "--no-forks"
+    __git_spindle_options "--no-forks --cached"
 }
 
 _git_spindle_set_origin() {
@@ -1011,6 +1017,12 @@ _git_spindle_snippet() {
     _git_spindle_gist
 }
 
+_git_spindle_sync() {
+    __git_spindle_options && return
+
+    [ ${#previous_args[@]} -eq 1 ] && __git_spindle_repos $1
+}
+
 _git_spindle_unprotect() {
     __git_spindle_options && return
 
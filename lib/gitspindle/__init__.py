@@ -1,39 +1,103 @@
 import gitspindle.monkey
+import gitspindle.gitconfig as gitconfig
+import atexit
+import collections
+import contextlib
 import docopt
 import os
 import re
 import shlex
 import sys
 import tempfile
+import threading
 import whelk
 import time
 
-__all__ = ['GitSpindle', 'Credential', 'command', 'wants_parent', 'wants_root', 'hidden_command']
+__all__ = ['GitSpindle', 'Credential', 'command', 'wants_parent', 'wants_root', 'hidden_command',
+           'GitSpindleError', 'GitError', 'err', 'pprint', 'PY3', 'try_decode', 'raw_input']
 NO_VALUE_SENTINEL = 'NO_VALUE_SENTINEL'
 
-__builtins__['PY3'] = sys.version_info[0] > 2
+PY3 = sys.version_info[0] > 2
 if PY3:
     import urllib.parse as urlparse
     # On python 3, shell decodes into utf-8 as above
-    __builtins__['try_decode'] = lambda x: x
+    try_decode = lambda x: x
     # On python 3, raw_input has become input
-    __builtins__['raw_input'] = input
+    raw_input = input
 else:
     import urlparse
     # Try decoding as utf-8 only
-    __builtins__['try_decode'] = lambda x: x.decode('utf-8')
+    try_decode = lambda x: x.decode('utf-8')
+    # The builtin, but importable from here too
+    raw_input = raw_input
 
-def err(msg):
-    sys.stderr.write(msg + "\n")
-    sys.exit(1)
-__builtins__['err'] = err
+class GitSpindleError(Exception):
+    """An error that stops a command. On the command line, the message is
+       shown and git-spindle exits with the returncode"""
+    def __init__(self, message, returncode=1):
+        super(GitSpindleError, self).__init__(message)
+        self.message = message
+        self.returncode = returncode
 
-import pprint
-__builtins__['pprint'] = pprint.pprint
-del pprint
+class GitError(GitSpindleError):
+    """A git command that had to succeed failed"""
 
-sys.stdout = open(sys.stdout.fileno(), mode='w', encoding=sys.stdout.encoding, errors='backslashreplace')
-sys.stderr = open(sys.stderr.fileno(), mode='w', encoding=sys.stderr.encoding, errors='backslashreplace')
+def err(msg):
+    raise GitSpindleError(msg)
+
+def pprint(*args, **kwargs):
+    import pprint
+    pprint.pprint(*args, **kwargs)
+
+class Stats(collections.Counter):
+    """A Counter that several threads can add to at once"""
+    def __init__(self, *args, **kwargs):
+        super(Stats, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def add(self, key, value=1):
+        with self.lock:
+            self[key] += value
+
+# Counters for things that are expensive, such as spawning git processes.
+# They are shown on exit when $GITSPINDLE_STATS is set.
+stats = Stats()
+
+def print_stats():
+    for key in sorted(stats):
+        sys.stderr.write("%s: %d\n" % (key, stats[key]))
+
+# How long a cached identity (see GitSpindle.use_cached_identity) is
+# trusted before the token is validated again, in seconds
+IDENTITY_TTL = 24 * 3600
+
+# How long to wait for another git or git-spindle process to release a lock
+# on a config file, in seconds
+CONFIG_LOCK_TIMEOUT = 10
+
+# Git commands that never change the configuration of a repository
+READ_ONLY_GIT_COMMANDS = ('cat-file', 'diff', 'for-each-ref', 'log', 'ls-remote', 'ls-tree', 'merge-base',
+                          'rev-list', 'rev-parse', 'shortlog', 'show', 'show-ref', 'status', 'var')
+
+def git_command(args):
+    """Find the git subcommand in a list of arguments to git"""
+    args = iter(args)
+    for arg in args:
+        if arg in ('-c', '-C', '--git-dir', '--work-tree'):
+            next(args, None)
+        elif not str(arg).startswith('-'):
+            return arg
+
+def cache_path(*path):
+    """A path in git-spindle's cache directory"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'git-spindle', *path)
+
+def config_key(key):
+    """Canonical form of a config key: section and name are case insensitive"""
+    section, _, key = key.partition('.')
+    subsection, _, name = key.rpartition('.')
+    return '.'.join([section.lower()] + [subsection] * bool(subsection) + [name.lower()])
 
 def command(fnc):
     fnc.is_command = True
@@ -62,13 +126,12 @@ class GitSpindle(object):
 
     def __init__(self):
         self.shell = whelk.Shell(encoding='utf-8')
-        self.git = self.shell.git
-        self.git_dir = self.git('rev-parse', '--git-dir')
-        if self.git_dir.returncode == 0:
-            self.git_dir = os.path.abspath(self.git_dir.stdout.strip())
-        else:
-            self.git_dir = None
-        self.in_repo = bool(self.git_dir)
+        self.config_cache = {}
+        # API requests may be done from several threads, and read config
+        self.config_lock = threading.RLock()
+        self.transaction = None
+        self.query_backend = None
+        self.find_git_dir()
         self.config_file = os.path.join(os.path.expanduser('~'), '.gitspindle')
         xdg_dir = os.environ.get('XDG_CONFIG_HOME', os.path.join(os.path.expanduser('~'), '.config'))
         xdg_file = os.path.join(xdg_dir, 'git', 'spindle')
@@ -76,23 +139,139 @@ class GitSpindle(object):
             self.config_file = xdg_file
         self.commands = {}
         self.accounts = {}
-        self.my_login = {}
-        self.use_credential_helper = self.git('config', 'credential.helper').stdout.strip() not in ('', 'cache')
-
-        self.usage = """%s - %s integration for git
-A full manual can be found on http://seveas.github.com/git-spindle/
-
-Usage:\n""" % (self.prog, self.what)
-        for name in sorted(dir(self)):
-            fnc = getattr(self, name)
+        self.hosts = list(self.hosts)
+        self.logged_in = False
+        self.identity = None
+        self.identity_secret = None
+        self.identity_cached = False
+        self.me_ = None
+        self.use_credential_helper = self.git_config('credential.helper') not in ('', 'cache')
+
+        for name in sorted(dir(self.__class__)):
+            fnc = getattr(self.__class__, name)
             if not getattr(fnc, 'is_command', False):
                 continue
+            fnc = getattr(self, name)
             if name.endswith('_'):
                 name = name[:-1]
             name = name.replace('_', '-')
             self.commands[name] = fnc
-            self.usage += '\n%s\n' % self.command_usage(name)
-        self.usage += """
+
+    def find_git_dir(self):
+        self.git_dir = self.git('rev-parse', '--git-dir')
+        if self.git_dir.returncode == 0:
+            self.git_dir = os.path.abspath(self.git_dir.stdout.strip())
+        else:
+            self.git_dir = None
+        self.in_repo = bool(self.git_dir)
+
+    @property
+    def me(self):
+        """The authenticated user, fetched from the API the first time it is used"""
+        if self.me_ is None:
+            self.fetch_identity()
+        return self.me_
+
+    @property
+    def my_login(self):
+        return self.identity and self.identity['login']
+
+    def identity_file(self):
+        import hashlib
+        key = '\0'.join([self.spindle, self.api_root(), self.identity_secret])
+        return cache_path('identity', hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def use_cached_identity(self, secret):
+        """Use the identity that was last fetched for this token or password,
+           if it is not too old. Returns whether it was usable"""
+        import json
+        self.identity_secret = secret
+        try:
+            with open(self.identity_file()) as fd:
+                identity = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return False
+        import gitspindle.offline as offline
+        if not 0 <= time.time() - identity.get('fetched-at', 0) < IDENTITY_TTL and not offline.is_offline():
+            return False
+        self.identity = identity
+        self.identity_cached = True
+        stats.add('cached identities used')
+        return True
+
+    def fetch_identity(self):
+        """Fetch the authenticated user and remember the identity"""
+        import json
+        self.me_, identity = self.get_identity()
+        identity['fetched-at'] = time.time()
+        self.identity = identity
+        self.identity_cached = False
+        self.config('user', identity['login'])
+        import gitspindle.offline as offline
+        if offline.is_offline(self.api_server()):
+            # Don't pass off cached data as fresh
+            return
+        file = self.identity_file()
+        if not os.path.exists(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file), 0o700)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file))
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(identity, fd)
+        gitconfig.replace(tmp, file)
+
+    def check_identity(self):
+        """Make sure that the credentials of a cached identity are accepted"""
+        import gitspindle.offline as offline
+        if self.identity_cached and not offline.is_offline(self.api_server()):
+            self.fetch_identity()
+
+    def forget_identity(self):
+        if self.identity_secret and os.path.exists(self.identity_file()):
+            os.unlink(self.identity_file())
+        self.identity = self.me_ = None
+        self.identity_cached = False
+
+    def is_auth_error(self, exc):
+        """Whether an exception means that the credentials were rejected"""
+        return False
+
+    def api_server(self):
+        """Where API requests go to"""
+        return self.api_root()
+
+    def budget(self):
+        """The rate limit budget of the logged in account, if known"""
+        return None
+
+    def for_each(self, func, items):
+        """Like map(func, items), where func does API requests. The calls are
+           done concurrently, see gitspindle.bulk. Results are yielded in
+           order"""
+        import gitspindle.bulk as bulk
+        concurrency = self.git_config('gitspindle.concurrency') or str(bulk.CONCURRENCY)
+        if not concurrency.isdigit() or int(concurrency) <= 0:
+            err("gitspindle.concurrency must be a positive number, not %s" % concurrency)
+        concurrency = int(concurrency)
+        return bulk.map(func, items, self.api_server(), self.budget(), concurrency)
+
+    def warm_up(self):
+        """Connect to the API server while we log in and look at the local
+           repository, so the first request does not have to wait for it"""
+        import gitspindle.offline as offline
+        if self.git_config_bool('gitspindle.no-warm-up') or offline.is_offline():
+            return
+        import gitspindle.transport as transport
+        transport.get(self.api_server()).warm_up()
+
+    def usage(self, *commands):
+        """The docopt usage for the given commands, or for all of them"""
+        usage = """%s - %s integration for git
+A full manual can be found on http://seveas.github.com/git-spindle/
+
+Usage:\n""" % (self.prog, self.what)
+        for name in commands or sorted(self.commands):
+            usage += '\n%s\n' % self.command_usage(name)
+        usage += """
 Options:
   -h --help              Show this help message and exit
   --desc=<description>   Description for the new gist/repo
@@ -103,7 +282,12 @@ Options:
   --ssh                  Use ssh:// urls for cloning 3rd party repos
   --git                  Use git:// urls for cloning 3rd party repos
   --goblet               When mirroring, set up goblet configuration
-  --account=<account>    Use another account than the default\n"""
+  --account=<account>    Use another account than the default
+  --refresh              Look up repositories again instead of using the cache
+  --cached               Use the local index made by sync instead of the API
+  --search=<words>       Search the local index for issues with these words
+  --offline              Only use cached data, don't contact the service\n"""
+        return usage
 
     def command_usage(self, name):
         if name not in self.commands.keys():
@@ -115,15 +299,114 @@ Options:
             doc[0] = ' ' + doc[0]
         return '%s:\n  %s %s %s%s' % (doc[1], self.prog, '[options]', name, doc[0])
 
+    def git(self, *args, **kwargs):
+        """Run a git command, forgetting cached config if it may change it"""
+        stats.add('git processes')
+        command = git_command(args)
+        if command not in READ_ONLY_GIT_COMMANDS and not \
+           (command == 'config' and set(args) & set(('-l', '--list', '--get', '--get-all', '--get-regexp'))):
+            self.forget_config()
+            if self.query_backend:
+                self.query_backend.reset()
+        return self.shell.git(*args, **kwargs)
+
     def gitm(self, *args, **kwargs):
         """A git command thas must be succesfull"""
         result = self.git(*args, **kwargs)
         if not result:
-            if result.stderr:
-                sys.stderr.write(result.stderr)
-            sys.exit(result.returncode)
+            raise GitError(result.stderr.rstrip('\n'), result.returncode)
         return result
 
+    def query(self):
+        """The backend for read-only object queries, see gitspindle.gitquery"""
+        if not self.query_backend:
+            import gitspindle.gitquery
+            name = self.git_config('gitspindle.query-backend') or None
+            if name and name not in gitspindle.gitquery.backends:
+                err("Unknown query backend %s, use one of %s" % (name, ', '.join(sorted(gitspindle.gitquery.backends))))
+            self.query_backend = gitspindle.gitquery.backend(name, stats)
+        stats.add('git queries')
+        return self.query_backend
+
+    def rev_parse(self, name):
+        """Like git rev-parse --verify --quiet <name>"""
+        return self.query().resolve(name) or ''
+
+    def object_type(self, name):
+        """Like git cat-file -t <name>"""
+        return self.query().object_type(name) or ''
+
+    def object_contents(self, name):
+        """Like git cat-file blob <name>"""
+        return (self.query().contents(name) or b'').decode('utf-8')
+
+    def merge_base(self, rev1, rev2):
+        """Like git merge-base <rev1> <rev2>"""
+        query = self.query()
+        if hasattr(query, 'merge_base'):
+            return query.merge_base(rev1, rev2) or ''
+        return self.git('merge-base', rev1, rev2).stdout.strip()
+
+    def git_config_snapshot(self, file=None):
+        """All values in a config file, or in the config of the current
+           repository, read with a single git process and kept until
+           something may have changed it"""
+        cache_key = ('file', file) if file else ('repo', os.getcwd())
+        with self.config_lock:
+            if cache_key not in self.config_cache:
+                values, index = [], {}
+                if not file or os.path.exists(file):
+                    result = self.git('config', *(('--file', file) if file else ()) + ('--list', '-z'))
+                    if result.returncode not in (0, 1): # 128 is returned for parse errors
+                        raise GitError(result.stderr.rstrip(), result.returncode)
+                    for entry in result.stdout.split('\0'):
+                        if entry:
+                            key, newline, value = entry.partition('\n')
+                            value = value if newline else None
+                            values.append((key, value))
+                            index.setdefault(key, []).append(value)
+                self.config_cache[cache_key] = (values, index)
+            return self.config_cache[cache_key]
+
+    def forget_config(self):
+        """Forget cached config values, as something may have changed them"""
+        with self.config_lock:
+            self.config_cache.clear()
+
+    def git_config(self, key, file=None):
+        """Get a value, like git config [--file <file>] <key>"""
+        values = self.git_config_snapshot(file)[1].get(config_key(key))
+        return (values[-1] or '') if values else ''
+
+    def git_config_bool(self, key, file=None):
+        """Get a boolean value, like git config --bool [--file <file>] <key>"""
+        values = self.git_config_snapshot(file)[1].get(config_key(key))
+        if not values:
+            return False
+        return values[-1] is None or values[-1].lower() in ('true', 'yes', 'on') or \
+               (values[-1].isdigit() and int(values[-1]) != 0)
+
+    def git_config_regexp(self, regexp, file=None):
+        """Get keys and values, like git config [--file <file>] --get-regexp <regexp>"""
+        regexp = re.compile(regexp)
+        return [(key, value or '') for (key, value) in self.git_config_snapshot(file)[0] if regexp.search(key)]
+
+    @contextlib.contextmanager
+    def config_transaction(self):
+        """Collect the config changes made in a with-block and apply them all
+           at the end, or none of them if something fails"""
+        if self.transaction is not None:
+            yield self.transaction
+            return
+        self.transaction = ConfigTransaction(self)
+        try:
+            yield self.transaction
+            self.transaction.commit()
+        except gitconfig.ConfigError:
+            err(str(sys.exc_info()[1]))
+        finally:
+            self.transaction = None
+
     def config(self, key, value=NO_VALUE_SENTINEL):
         if key in ('token', 'password') and self.use_credential_helper:
             return self.config_secret(key, value)
@@ -132,19 +415,12 @@ Options:
             section = '%s.%s' % (self.spindle, self.account)
         key = '%s.%s' % (section, key)
         if value is NO_VALUE_SENTINEL:
-            result = self.git('config', '--file', self.config_file, key)
-            if result.returncode not in (0, 1): # 128 is returned for parse errors
-                print(result.stderr.rstrip())
-                sys.exit(result.returncode)
-            return result.stdout.strip()
-        elif value is None:
-            self.gitm('config', '--file', self.config_file, '--unset', key)
-        else:
-            try:
-                umask = os.umask(63) # 0x077
-                return self.gitm('config', '--file', self.config_file, key, value)
-            finally:
-                os.umask(umask)
+            return self.git_config(key, file=self.config_file).strip()
+        with self.config_transaction() as config:
+            if value is None:
+                config.unset(key, file=self.config_file)
+            else:
+                config.set(key, value, file=self.config_file)
 
     def config_secret(self, key, value=NO_VALUE_SENTINEL):
         url = urlparse.urlparse(self.api_root())
@@ -168,10 +444,8 @@ Options:
         return [url.hostname] + self.parse_url(url)
 
     def remotes(self):
-        confremotes = self.git('config', '--get-regexp', 'remote\..*\.url').stdout.strip().splitlines()
         ret = {}
-        for remote in confremotes:
-            remote, url = remote.split()
+        for remote, url in self.git_config_regexp('remote\..*\.url'):
             remote = remote.split('.')[1]
             ret[remote] = url
         return ret
@@ -194,10 +468,8 @@ Options:
             # Let git tell the user that we don't know what to do
             self.gitm('rev-parse')
         else:
-            confremotes = self.git('config', '--get-regexp', 'remote\..*\.url').stdout.strip().splitlines()
             first = None
-            for remote in confremotes:
-                remote, url = remote.split()
+            for remote, url in self.git_config_regexp('remote\..*\.url'):
                 remote = remote.split('.')[1]
                 host, user, repo = self._parse_url(url)
                 if repo and not first:
@@ -215,27 +487,150 @@ Options:
         if repo and repo.endswith('.git'):
             repo = repo[:-4]
 
-        repo_ = self.get_repo(remote, user, repo)
+        cache = self.repo_cache()
+        repo_ = self.lookup_repo(cache, remote, user, repo)
 
         if not repo_:
             err("Repository %s/%s could not be found on %s" % (user, repo, self.what))
 
         repo_.remote = remote
         if opts['--parent'] or opts['--maybe-parent']:
-            parent = self.parent_repo(repo_)
+            parent = self.lookup_parent(cache, repo_)
             if parent:
                 repo_ = parent
             elif opts['--parent']:
                 err("No parent repo found for %s/%s" % (user, repo))
 
         if opts['--root']:
-            parent = self.parent_repo(repo_)
+            parent = self.lookup_parent(cache, repo_)
             while parent:
                 repo_ = parent
-                parent = self.parent_repo(repo_)
+                parent = self.lookup_parent(cache, repo_)
+
+        return repo_
 
+    def repo_cache(self):
+        """The metadata cache for the repositories the current repository
+           belongs to, see gitspindle.repocache. None outside a repository or
+           when it is turned off"""
+        if not self.in_repo:
+            return None
+        import gitspindle.repocache as repocache
+        ttl = self.git_config('gitspindle.repository-cache-ttl')
+        ttl = int(ttl) if ttl else repocache.TTL
+        if ttl <= 0:
+            return None
+        account = '\0'.join([self.spindle, self.api_root(), self.my_login or ''])
+        return repocache.Cache(self.git_dir, account, ttl)
+
+    def repo_metadata(self, repo):
+        """The name and the attributes to cache of a repository, or None if
+           it should not be cached"""
+        return None
+
+    def lean_repo(self, attributes):
+        """An API object made from cached attributes without a request, whose
+           methods can be used. None if that is not possible"""
+        return None
+
+    def metadata(self, repo):
+        import gitspindle.repocache as repocache
+        if isinstance(repo, repocache.Repository):
+            return repo._cache_name, repo._cache_attributes
+        return self.repo_metadata(repo)
+
+    def cached_repo(self, cache, name, attributes):
+        """A repository from the cache, the full repository is fetched when
+           needed"""
+        import gitspindle.repocache as repocache
+        def fetch():
+            repo = self.refetch_repo(attributes)
+            if not repo:
+                cache.forget(name)
+                err("Repository %s could not be found on %s" % (name, self.what))
+            return repo
+        return repocache.Repository(name, attributes, fetch, self.lean_repo(attributes))
+
+    def lookup_repo(self, cache, remote, user, repo):
+        """Like get_repo, but answered from the cache if possible"""
+        if not cache:
+            return self.get_repo(remote, user, repo)
+        url = remote and self.git_config('remote.%s.url' % remote)
+        key = '\0'.join([url or '', user or '', repo])
+        found = not self.refresh and cache.lookup(key)
+        if found:
+            return self.cached_repo(cache, *found)
+        repo_ = self.get_repo(remote, user, repo)
+        metadata = repo_ and self.repo_metadata(repo_)
+        if metadata:
+            cache.add(metadata[0], metadata[1], key)
         return repo_
 
+    def lookup_parent(self, cache, repo):
+        """Like parent_repo, but answered from the cache if possible"""
+        metadata = cache and self.metadata(repo)
+        if not metadata:
+            return self.parent_repo(repo)
+        if not self.refresh:
+            known, parent = cache.parent(metadata[0])
+            if known:
+                return parent and self.cached_repo(cache, *parent)
+        parent = self.parent_repo(repo)
+        parent_metadata = parent and self.metadata(parent)
+        if parent_metadata or not parent:
+            cache.add_parent(metadata[0], parent_metadata)
+        return parent
+
+    def index(self):
+        """The local index of the account, see gitspindle.index"""
+        import hashlib
+        import gitspindle.index as index
+        key = '\0'.join([self.spindle, self.api_root(), self.my_login or ''])
+        return index.Index(cache_path('index', hashlib.sha256(key.encode('utf-8')).hexdigest() + '.sqlite'))
+
+    def open_index(self):
+        """The local index, which must have been synced"""
+        import gitspindle.offline as offline
+        index = self.index()
+        synced = index.synced()
+        if synced is None:
+            index.close()
+            err("The local index is empty, use %s sync to fill it" % self.prog)
+        offline.used(synced)
+        return index
+
+    def cached_repos(self, owner=None):
+        """Repositories from the index, of all owners unless owner is given"""
+        index = self.open_index()
+        try:
+            return index.repositories(owner)
+        finally:
+            index.close()
+
+    def cached_issues(self, names, states=None, closed=None, search=None):
+        """Issues and pull requests from the index, as (repository, issues,
+           pull requests) tuples like the issues commands fetch them. names
+           are the repositories to list them for, or None for all of them"""
+        index = self.open_index()
+        try:
+            repos = dict((name, repo) for (name, repo) in index.repositories(with_names=True))
+            found = collections.OrderedDict()
+            for name, kind, issue in index.issues(names, states, closed, search):
+                found.setdefault(name, ([], []))[kind != 'issue'].append(issue)
+        finally:
+            index.close()
+        return [(repos[name], issues, pulls) for (name, (issues, pulls)) in found.items() if name in repos]
+
+    def index_releases(self, repo):
+        """The releases of a repository to index, as (tag, name, body, url)
+           tuples, or None if there are none"""
+        return None
+
+    def index_members(self, repo):
+        """The members of a repository to index, as (login, access) tuples,
+           or None if they can't be listed"""
+        return None
+
     def question(self, question, default=True):
         yn = ['y/N', 'Y/n'][default or self.assume_yes]
         if self.assume_yes:
@@ -307,9 +702,9 @@ Options:
         return temp_file
 
     def repo_root(self):
-        root = self.shell.git('rev-parse', '--show-toplevel').stdout.strip()
+        root = self.git('rev-parse', '--show-toplevel').stdout.strip()
         if not root:
-            root = self.shell.git('rev-parse', '--git-dir').stdout.strip()
+            root = self.git('rev-parse', '--git-dir').stdout.strip()
         root = os.path.abspath(root)
         return root
 
@@ -327,48 +722,170 @@ Options:
         if triangular and upstream:
             pushremote = remote
             pullremote = upstream
-            self.gitm('config', 'remote.pushDefault', pushremote)
         else:
             pushremote = None
             pullremote = remote
             upstream_branch = None
 
-        for branch in self.git('for-each-ref', 'refs/heads/**').stdout.strip().splitlines():
-            branch = branch.split(None, 2)[-1][11:]
-
-            if upstream_branch and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, upstream_branch)).stdout.strip():
-                tracking_remote = pullremote
-                tracking_branch = upstream_branch
-            elif self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, branch)).stdout.strip():
-                tracking_remote = pullremote
-                tracking_branch = branch
-            elif pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
-                tracking_remote = pushremote
-                tracking_branch = branch
-            else:
-                tracking_remote = None
-                tracking_branch = None
-
-            if tracking_remote and tracking_branch:
-                current = self.git('config', 'branch.%s.remote' % branch).stdout.strip()
-                if current in [remote, upstream, '']:
-                    print("Configuring branch %s to track branch %s on remote %s" % (branch, tracking_branch, tracking_remote))
-                    self.gitm('config', 'branch.%s.remote' % branch, tracking_remote)
-                    self.gitm('config', 'branch.%s.merge' % branch, 'refs/heads/%s' % tracking_branch)
-
-            if pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
-                current = self.git('config', 'branch.%s.pushremote' % branch).stdout.strip()
-                if current in [remote, upstream, '']:
-                    print("Configuring branch %s to push to remote %s" % (branch, pushremote))
-                    self.gitm('config', 'branch.%s.pushremote' % branch, pushremote)
+        # Read all refs at once. Like for-each-ref <pattern>, a remote branch
+        # also matches when it is a directory of refs, so add all parents too.
+        branches, remote_refs = [], set()
+        for ref in self.git('for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/remotes').stdout.splitlines():
+            if ref.startswith('refs/heads/'):
+                branches.append(ref[11:])
+                continue
+            ref = ref[13:]
+            while ref and ref not in remote_refs:
+                remote_refs.add(ref)
+                ref = ref.rpartition('/')[0]
+
+        with self.config_transaction() as config:
+            if pushremote:
+                config.set('remote.pushDefault', pushremote)
+
+            for branch in branches:
+                if upstream_branch and '%s/%s' % (pullremote, upstream_branch) in remote_refs:
+                    tracking_remote = pullremote
+                    tracking_branch = upstream_branch
+                elif '%s/%s' % (pullremote, branch) in remote_refs:
+                    tracking_remote = pullremote
+                    tracking_branch = branch
+                elif pushremote and '%s/%s' % (pushremote, branch) in remote_refs:
+                    tracking_remote = pushremote
+                    tracking_branch = branch
+                else:
+                    tracking_remote = None
+                    tracking_branch = None
+
+                if tracking_remote and tracking_branch:
+                    current = self.git_config('branch.%s.remote' % branch).strip()
+                    if current in [remote, upstream, '']:
+                        print("Configuring branch %s to track branch %s on remote %s" % (branch, tracking_branch, tracking_remote))
+                        config.set('branch.%s.remote' % branch, tracking_remote)
+                        config.set('branch.%s.merge' % branch, 'refs/heads/%s' % tracking_branch)
+
+                if pushremote and '%s/%s' % (pushremote, branch) in remote_refs:
+                    current = self.git_config('branch.%s.pushremote' % branch).strip()
+                    if current in [remote, upstream, '']:
+                        print("Configuring branch %s to push to remote %s" % (branch, pushremote))
+                        config.set('branch.%s.pushremote' % branch, pushremote)
+
+    def find_command(self, argv):
+        """Find the command in argv without parsing the full usage"""
+        args = iter(argv[len(self.prog.split()) - 1:])
+        for arg in args:
+            if arg == '--':
+                break
+            if arg in ('--desc', '--issue', '--account', '--search'):
+                next(args, None)
+            elif not arg.startswith('-'):
+                return arg if arg in self.commands else None
+
+    def option_defaults(self):
+        """The values docopt would give options and arguments of commands
+           that are not in the parsed usage, and the keys that it would make
+           lists of"""
+        defaults, lists = {}, set()
+        for name in self.commands:
+            defaults[name] = False
+            line = self.command_usage(name).split('[options] %s' % name, 1)[1]
+            tokens = re.sub(r'([\[\]\(\)\|]|\.\.\.)', r' \1 ', line).split()
+            for num, token in enumerate(tokens):
+                if token.startswith('git-') and token.endswith('-options'):
+                    tokens[num:num+1] = [opt.split()[0] for opt in gitspindle.monkey.known_options[token[4:-8]]]
+            seen = set()
+            for num, token in enumerate(tokens):
+                if token in ('[', ']', '(', ')', '|', '...'):
+                    continue
+                key = token.split('=')[0]
+                if key.startswith('<') or '=' in token:
+                    defaults[key] = None
+                    if key in seen or tokens[num+1:num+2] == ['...']:
+                        lists.add(key)
+                else:
+                    defaults.setdefault(key, False)
+                seen.add(key)
+        return defaults, lists
+
+    def parse_args(self, argv):
+        """Parse argv with the usage of only the command it invokes. The full
+           usage is only needed for the help output and for errors."""
+        command = self.find_command(argv)
+        if command:
+            try:
+                opts = docopt.docopt(self.usage(command), argv, help=False)
+            except docopt.DocoptExit:
+                opts = None
+            if opts and not opts['--help']:
+                defaults, lists = self.option_defaults()
+                for key in lists:
+                    if not isinstance(opts.get(key), list):
+                        opts[key] = [] if opts.get(key) is None else [opts[key]]
+                for key, value in defaults.items():
+                    opts.setdefault(key, [] if key in lists else value)
+                return opts
+        return docopt.docopt(self.usage(), argv)
 
     def main(self):
-        argv = self.prog.split()[1:] + sys.argv[1:]
-        opts = docopt.docopt(self.usage, argv)
-        self.assume_yes = opts['--yes']
-        hosts = self.git('config', '--file', self.config_file, '--get-regexp', '%s\..*\.host' % self.spindle).stdout.strip()
+        """The command line interface"""
+        sys.stdout = open(sys.stdout.fileno(), mode='w', encoding=sys.stdout.encoding, errors='backslashreplace')
+        sys.stderr = open(sys.stderr.fileno(), mode='w', encoding=sys.stderr.encoding, errors='backslashreplace')
+        if os.environ.get('GITSPINDLE_STATS'):
+            atexit.register(print_stats)
+        try:
+            self.execute(self.prog.split()[1:] + sys.argv[1:])
+        except GitSpindleError:
+            exc = sys.exc_info()[1]
+            if exc.message:
+                sys.stderr.write(exc.message + "\n")
+            sys.exit(exc.returncode)
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+    def run(self, argv, stdout=None, stderr=None):
+        """Run a command without the command line interface, e.g.
+           github.run(['clone', 'seveas/whelk']). Output goes to stdout and
+           stderr if given, errors are raised as GitSpindleError. The instance
+           can be reused for further commands."""
+        saved = sys.stdout, sys.stderr, os.getcwd(), os.environ.get('GITSPINDLE_ACCOUNT')
+        sys.stdout = stdout or sys.stdout
+        sys.stderr = stderr or sys.stderr
+        try:
+            self.execute(self.prog.split()[1:] + list(argv))
+        except SystemExit:
+            # Usage errors and --help from docopt, declined questions
+            code = sys.exc_info()[1].code
+            if code:
+                raise GitSpindleError(code if isinstance(code, str) else '', code if isinstance(code, int) else 1)
+        finally:
+            sys.stdout, sys.stderr = saved[:2]
+            os.chdir(saved[2])
+            if saved[3] is None:
+                os.environ.pop('GITSPINDLE_ACCOUNT', None)
+            else:
+                os.environ['GITSPINDLE_ACCOUNT'] = saved[3]
 
-        for (account, host) in [x.split() for x in hosts.splitlines()]:
+    def execute(self, argv):
+        opts = self.parse_args(argv)
+        self.assume_yes = opts['--yes']
+        self.refresh = opts['--refresh']
+        import gitspindle.offline as offline
+        offline.reset(opts['--offline'] or self.git_config_bool('gitspindle.offline'))
+        # Forget anything that may differ from the previous command
+        self.find_git_dir()
+        self.forget_config()
+        import gitspindle.memo as memo
+        memo.clear()
+        import gitspindle.httpcache as httpcache
+        httpcache.configure(self.git_config_bool('gitspindle.cache-authenticated-responses'))
+        import gitspindle.jsoncodec as jsoncodec
+        codec = self.git_config('gitspindle.json-codec') or None
+        if codec and codec not in jsoncodec.codecs:
+            err("Unknown JSON codec %s, use one of %s" % (codec, ', '.join(jsoncodec.preference)))
+        jsoncodec.use(codec)
+        self.hosts = list(type(self).hosts)
+        self.accounts = {}
+        for (account, host) in self.git_config_regexp('%s\..*\.host' % self.spindle, file=self.config_file):
             account = account.split('.')
             if host.startswith(('http://', 'https://')):
                 host = urlparse.urlparse(host).hostname
@@ -390,9 +907,9 @@ Options:
 
         # 3: If we have no [gitXXX], but do have [gitXXX "url"], use it.
         if not self.account and not self.config('user'):
-            accounts = self.git('config', '--file', self.config_file, '--get-regexp', '%s\..*\.user' % self.spindle).stdout.strip()
+            accounts = self.git_config_regexp('%s\..*\.user' % self.spindle, file=self.config_file)
             if accounts:
-                self.account = accounts.splitlines()[0].split('.')[1]
+                self.account = accounts[0][0].split('.')[1]
 
         os.environ['GITSPINDLE_ACCOUNT'] = self.account or self.spindle
         host = self.config('host')
@@ -401,8 +918,12 @@ Options:
 
         for command, func in self.commands.items():
             if opts[command]:
-                if not func.no_login:
+                if not func.no_login and self.logged_in != (self.account,):
+                    self.warm_up()
                     self.login()
+                    self.logged_in = (self.account,)
+                if not func.no_login:
+                    memo.check_before_changes(self.check_identity)
                 opts['command'] = command
                 if isinstance(opts[command], list):
                     opts['extra-opts'] = opts[command]
@@ -411,10 +932,31 @@ Options:
                     opts['extra-opts'] = []
                 opts['--maybe-parent'] = func.wants_parent
                 opts['--root'] = func.wants_root or '--root' in opts and opts['--root']
+                # Offline, listings come from the local index
+                can_use_index = '--cached' in self.command_usage(command)
+                if can_use_index and offline.is_offline():
+                    opts['--cached'] = True
                 try:
                     func(opts)
-                except KeyboardInterrupt:
-                    sys.exit(1)
+                except offline.OfflineError:
+                    if not can_use_index or opts['--cached']:
+                        raise
+                    sys.stderr.write("%s, using the local index instead\n" % sys.exc_info()[1].message)
+                    opts['--cached'] = True
+                    func(opts)
+                except Exception:
+                    # A cached identity means we did not check the
+                    # credentials, so check them now and try again. They
+                    # are checked before the first change, so nothing
+                    # was changed yet
+                    if not self.identity_cached or not self.is_auth_error(sys.exc_info()[1]):
+                        raise
+                    self.forget_identity()
+                    self.login()
+                    func(opts)
+                staleness = offline.staleness()
+                if staleness:
+                    sys.stderr.write(staleness + "\n")
                 break
 
     @command
@@ -450,6 +992,38 @@ Options:
         else:
             print(self.config(key))
 
+    @command
+    def sync(self, opts):
+        """[<repo>]
+           Update the local index that --cached uses"""
+        import gitspindle.offline as offline
+        if offline.is_offline():
+            err("The local index can't be updated while offline")
+        if opts['<repo>']:
+            repos = [self.repository(opts)]
+        else:
+            repos = self.index_all_repos()
+        entries = [self.index_repo(repo) for repo in repos]
+        index = self.index()
+        try:
+            index.update_repositories(entries, complete=not opts['<repo>'])
+            since = [None if self.refresh else index.since(entry[0], 'issues') for entry in entries]
+
+            def fetch(args):
+                repo, since = args
+                return since, self.index_issues(repo, since), self.index_releases(repo), self.index_members(repo)
+
+            # The index is only used in this thread, the fetching is done concurrently
+            for entry, (since, issues, releases, members) in zip(entries, self.for_each(fetch, list(zip(repos, since)))):
+                updated = [issue[5] for issue in issues if issue[5]]
+                index.update_issues(entry[0], issues, max(updated + [since or '']) or None)
+                if releases is not None:
+                    index.update_releases(entry[0], releases)
+                if members is not None:
+                    index.update_members(entry[0], members)
+        finally:
+            index.close()
+
     # And debugging
     @hidden_command
     def run_shell(self, opts):
@@ -486,7 +1060,7 @@ Options:
 
         namespace =  opts['--namespace'] or self.my_login
 
-        if self.api.__name__ == 'github3':
+        if self.spindle == 'github':
             if opts['--keys']:
                 for key in self.gh.iter_keys():
                     key.delete()
@@ -506,10 +1080,12 @@ Options:
                 # this is a bug GitHub is working on to get a fix, maybe some caching issue on their side
                 # so this code might be removed in the future
                 # wait for the deletions to be recognized, or the test assertions might fail later on
+                import gitspindle.memo as memo
                 i = 0
                 clean = False
                 while not clean and i < 120:
                     clean = True
+                    memo.clear()
                     for repo in self.gh.iter_repos():
                         if repo.owner.login == namespace:
                             clean = False
@@ -521,7 +1097,7 @@ Options:
                 for gist in self.gh.iter_gists():
                     gist.delete()
 
-        elif self.api.__name__ == 'gitspindle.bbapi':
+        elif self.spindle == 'bitbucket':
             if opts['--keys']:
                 for key in self.me.keys():
                     key.delete()
@@ -536,7 +1112,7 @@ Options:
                 for snippet in self.me.snippets():
                     snippet.delete()
 
-        elif self.api.__name__ == 'gitspindle.glapi':
+        elif self.spindle == 'gitlab':
             if opts['--keys']:
                 for key in self.me.Key():
                     key.delete()
@@ -548,9 +1124,94 @@ Options:
         else:
             raise UtterConfusion()
 
+class ConfigTransaction(object):
+    """Config changes that are applied together. Each file is rewritten once
+       and if any change fails, none of the files are changed."""
+
+    def __init__(self, spindle):
+        self.spindle = spindle
+        self.changes = collections.OrderedDict()
+        self.repo_configs = {}
+
+    def change(self, action, key, value, file):
+        if not file:
+            cwd = os.getcwd()
+            if cwd not in self.repo_configs:
+                self.repo_configs[cwd] = os.path.abspath(self.spindle.gitm('rev-parse', '--git-path', 'config').stdout.strip())
+            file = self.repo_configs[cwd]
+        self.changes.setdefault(file, []).append((action, key, value))
+
+    def set(self, key, value, file=None):
+        self.change('set', key, value, file)
+
+    def add(self, key, value, file=None):
+        self.change('add', key, value, file)
+
+    def replace_all(self, key, value, file=None):
+        self.change('replace_all', key, value, file)
+
+    def unset(self, key, file=None):
+        self.change('unset', key, None, file)
+
+    def changed(self, path, changes):
+        """Whether applying the changes would change any value in the file"""
+        index = self.spindle.git_config_snapshot(path)[1]
+        values = {}
+        for action, key, value in changes:
+            key = config_key(key)
+            before = values.setdefault(key, list(index.get(key, [])))
+            if action == 'set' and len(before) > 1:
+                # Let the config file raise the error
+                return True
+            if action == 'add':
+                values[key] = before + ['%s' % value]
+            elif action in ('set', 'replace_all'):
+                values[key] = ['%s' % value]
+            else:
+                values[key] = before[1:] if len(before) == 1 else before
+        return any(values[key] != index.get(key, []) for key in values)
+
+    def commit(self):
+        files = []
+        # Always lock in the same order, so concurrent transactions that
+        # touch the same files cannot deadlock
+        paths = sorted(path for path in self.changes if self.changed(path, self.changes[path]))
+        try:
+            for path in paths:
+                changes = self.changes[path]
+                file = gitconfig.ConfigFile(path, private=path == self.spindle.config_file)
+                files.append(file)
+                file.lock(timeout=CONFIG_LOCK_TIMEOUT)
+                if file.retries:
+                    stats.add('config lock retries', file.retries)
+                for action, key, value in changes:
+                    if action == 'unset':
+                        file.unset(key)
+                    else:
+                        getattr(file, action)(key, value)
+                file.write()
+        except:
+            for file in files:
+                file.rollback()
+            raise
+        finally:
+            self.spindle.forget_config()
+        for num, file in enumerate(files):
+            try:
+                file.commit()
+                stats.add('config files written')
+            except:
+                for file in files[:num]:
+                    file.restore()
+                for file in files[num:]:
+                    file.rollback()
+                raise
+
 class Credential(object):
     shell = whelk.Shell(encoding='utf-8')
     params = ['protocol', 'host', 'path', 'username', 'password']
+    # Results of fill, so helpers are asked only once per process
+    filled = {}
 
     def __init__(self, protocol, host, path='', username='', password=''):
         self.protocol = protocol
@@ -569,25 +1230,64 @@ class Credential(object):
         self.communicate('fill')
 
     def fill_noninteractive(self):
-        env = os.environ.copy()
-        env['GIT_TERMINAL_PROMPT'] = '0'
-        env.pop('GIT_ASKPASS', None)
-        env.pop('SSH_ASKPASS', None)
-        self.communicate('fill', env=env)
+        key = self.key()
+        if key in self.filled:
+            stats.add('cached credential lookups')
+            self.username, self.password = self.filled[key]
+            return
+        if not self.shared_cache('get'):
+            env = os.environ.copy()
+            env['GIT_TERMINAL_PROMPT'] = '0'
+            env.pop('GIT_ASKPASS', None)
+            env.pop('SSH_ASKPASS', None)
+            self.communicate('fill', env=env)
+            if self.password:
+                self.shared_cache('store')
+        self.filled[key] = (self.username, self.password)
 
     def approve(self):
         if not self.username or not self.password:
             raise ValueError("No username or password specified")
         self.communicate('approve')
+        self.shared_cache('store')
+        self.forget()
+        self.filled[self.key()] = (self.username, self.password)
 
     def reject(self):
         if not self.username:
             raise ValueError("No username specified")
         self.communicate('reject')
+        self.shared_cache('erase')
+        self.forget()
         self.password = ''
 
+    def key(self):
+        return (self.protocol, self.host, self.path, self.username)
+
+    def forget(self):
+        """Forget filled credentials for this url, whatever the username"""
+        for key in list(self.filled):
+            if key[:3] == self.key()[:3]:
+                del self.filled[key]
+
+    def shared_cache(self, action):
+        """Use git's credential cache to share credentials between
+           invocations, if GITSPINDLE_CREDENTIAL_CACHE is set to the number of
+           seconds to keep them. Returns whether a password was found."""
+        timeout = os.environ.get('GITSPINDLE_CREDENTIAL_CACHE', '')
+        if not timeout.isdigit() or not int(timeout):
+            return False
+        stats.add('git processes')
+        ret = self.shell.git('credential-cache', '--timeout', timeout, '--socket', cache_path('credential-cache', 'socket'),
+                             action, input=self.format() + '\n\n')
+        if action != 'get' or not ret:
+            return False
+        self.parse(ret.stdout)
+        return bool(self.password)
+
     def communicate(self, action, env=os.environ):
         data = self.format() + '\n\n'
+        stats.add('git processes')
         if env.get('GIT_TERMINAL_PROMPT', None) == '0':
             ret = self.shell.git('-c', 'core.askpass=', 'credential', action, env=env, input=data)
         else:
@@ -1,12 +1,14 @@
+import gitspindle.jsoncodec as jsoncodec
+import gitspindle.pages as pages
+import gitspindle.transport as transport
 import json
 from operator import attrgetter
-import requests
 import uritemplate
 
 def check(resp):
     if resp.status_code not in (200, 201, 204):
         try:
-            message = resp.json()['error']['message']
+            message = jsoncodec.loads(resp.content)['error']['message']
         except (KeyError, ValueError):
             message = resp.content
 
@@ -28,13 +30,25 @@ def check(resp):
         raise BitBucketError(message)
     if not resp.content:
         return None
-    return resp.json()
+    return jsoncodec.loads(resp.content)
 
 class Bitbucket(object):
     def __init__(self, username, passwd):
         self.username = username
         self.passwd = passwd
 
+    def request(self, method, url, data=None, **kwargs):
+        kwargs['auth'] = (self.username, self.passwd)
+        return check(transport.get(url).request(method, url, data=data, **kwargs))
+
+    def budget(self, url):
+        """The rate limit budget for requests to url"""
+        return transport.get(url).budget(auth=(self.username, self.passwd))
+
+    def workers(self, url):
+        """How many requests to url can be done in parallel"""
+        return self.budget(url).workers()
+
     def user(self, username):
         return User(self, username=username)
 
@@ -76,10 +90,7 @@ class BBobject(object):
                 self.data.update(self.get(url))
         elif mode == 'list':
             self.instances = []
-            url = self.url[0]
-            while url:
-                instances = self.get(url)
-                url = instances['next'] if 'next' in instances else None
+            for instances in self.pages(self.url[0]):
                 for instance in instances['values'] if 'values' in instances else instances:
                     kw = kwargs.copy()
                     kw.update(instance)
@@ -94,25 +105,38 @@ class BBobject(object):
             else:
                 setattr(self, datum, self.data[datum])
 
+    def pages(self, url, params=None):
+        """Yields all pages of a listing. If the first page says how many
+           there are, the rest are fetched in parallel"""
+        page = self.get(url, params=params)
+        yield page
+        if 'next' not in page:
+            return
+        if page.get('size') and page.get('pagelen'):
+            last = (page['size'] + page['pagelen'] - 1) // page['pagelen']
+            urls = pages.page_urls(page['next'], pages.page_number(page['next']) or 2, last)
+            for page in pages.fetch(self.get, urls, self.bb.workers(url)):
+                yield page
+            return
+        while 'next' in page:
+            page = self.get(page['next'])
+            yield page
+
     @classmethod
     def list(klass, bb, **kwargs):
         return klass(bb, mode="list", **kwargs).instances
 
     def get(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.get(*args, **kwargs))
+        return self.bb.request('GET', *args, **kwargs)
 
     def post(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.post(*args, **kwargs))
+        return self.bb.request('POST', *args, **kwargs)
 
     def put(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.put(*args, **kwargs))
+        return self.bb.request('PUT', *args, **kwargs)
 
     def delete_(self, *args, **kwargs):
-        kwargs.update({'auth': (self.bb.username, self.bb.passwd)})
-        return check(requests.delete(*args, **kwargs))
+        return self.bb.request('DELETE', *args, **kwargs)
 
 class User(BBobject):
     uri = 'https://api.bitbucket.org/2.0/users/{username}'
@@ -144,10 +168,17 @@ class User(BBobject):
     def keys(self):
         return Key.list(self.bb, user=self.username)
 
-    def repositories(self):
+    def repositories(self, fields=None):
+        """The user's repositories. If fields are given, only those are
+           fetched. Other attributes are fetched when they are used"""
         url = uritemplate.expand('https://api.bitbucket.org/2.0/repositories/{owner}', owner=self.username)
-        data = self.get(url)['values']
-        return [Repository(self.bb, mode=None, **repo) for repo in data]
+        params = None
+        if fields:
+            # The full name is needed to fetch the rest
+            fields = ['full_name'] + [field for field in fields if field != 'full_name']
+            # And what's needed to find the other pages
+            params = {'fields': ','.join(['next', 'size', 'pagelen'] + ['values.' + field for field in fields])}
+        return [Repository(self.bb, mode=None, _lean=bool(fields), **repo) for page in self.pages(url, params) for repo in page['values']]
 
     def snippets(self):
         url = uritemplate.expand('https://api.bitbucket.org/2.0/snippets/{owner}', owner=self.username)
@@ -202,12 +233,21 @@ class Repository(BBobject):
 
     def __init__(self, *args, **kwargs):
         super(Repository, self).__init__(*args, **kwargs)
-        if not hasattr(self, 'links'):
+        if 'links' not in self.__dict__:
             return
         links, self.links['clone'] = self.links['clone'], {}
         for link in links:
             self.links['clone'][link['name']] = ssh_fix(link['href'])
 
+    def __getattr__(self, name):
+        # Repositories listed with only some fields fetch the rest on demand
+        if name.startswith('__') or not self.__dict__.get('_lean'):
+            raise AttributeError(name)
+        self._lean = False
+        owner, slug = self.full_name.split('/', 1)
+        self.__dict__.update(Repository(self.bb, owner=owner, slug=slug).__dict__)
+        return getattr(self, name)
+
     def fork(self):
         self.post(self.url[0] + '/fork', data={'name': self.name})
         for _ in range(5):
@@ -223,10 +263,11 @@ class Repository(BBobject):
         branches = self.get(self.url[0] + '/branches')
         return dict([(key, Branch(self.bb, mode=None, repository=self, **val)) for (key, val) in branches.items()])
 
-    def pull_requests(self, **params):
-        url = 'https://api.bitbucket.org/2.0/repositories/%s/pullrequests?state=OPEN' % self.full_name
-        data = self.get(url)['values']
-        return [PullRequest(self.bb, mode=None, **pr) for pr in data]
+    def pull_requests(self, states=('OPEN',), query=None):
+        url = 'https://api.bitbucket.org/2.0/repositories/%s/pullrequests?%s' % (self.full_name, '&'.join('state=%s' % state for state in states))
+        if query:
+            url = '%s&q=%s' % (url, query)
+        return [PullRequest(self.bb, mode=None, **pr) for page in self.pages(url) for pr in page['values']]
 
     def pull_request(self, number):
         owner, slug = self.full_name.split('/')
@@ -247,8 +288,7 @@ class Repository(BBobject):
         url = 'https://api.bitbucket.org/2.0/repositories/%s/issues' % self.full_name
         if query:
             url = '%s?q=%s' % (url, query)
-        data = self.get(url)['values']
-        return [Issue(self.bb, mode=None, **issue) for issue in data]
+        return [Issue(self.bb, mode=None, **issue) for page in self.pages(url) for issue in page['values']]
 
     def issue(self, id):
         return Issue(self.bb, owner=self.owner['username'], slug=self.slug, id=id, repo=self)
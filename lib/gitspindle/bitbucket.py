@@ -5,7 +5,6 @@ import getpass
 import glob
 import os
 import sys
-import webbrowser
 import binascii
 
 class BitBucket(GitSpindle):
@@ -13,13 +12,12 @@ class BitBucket(GitSpindle):
     what = 'BitBucket'
     spindle = 'bitbucket'
     hosts = ['bitbucket.org', 'www.bitbucket.org']
-    api = bbapi
 
     def __init__(self):
         super(BitBucket, self).__init__()
         if self.use_credential_helper:
             # Git Credential Manager creates a token with too few scopes
-            self.use_credential_helper = self.git('config', 'credential.helper').stdout.strip() != 'manager'
+            self.use_credential_helper = self.git_config('credential.helper') != 'manager'
 
     # Support functions
     def login(self):
@@ -45,7 +43,8 @@ class BitBucket(GitSpindle):
             wrong_password = False
             try:
                 self.bb = bbapi.Bitbucket(user, password)
-                self.me = self.bb.user(user)
+                self.identity_secret = '%s:%s' % (user, password)
+                self.fetch_identity()
             except bbapi.BitBucketAuthenticationError:
                 wrong_password = True
             if wrong_password:
@@ -56,30 +55,82 @@ class BitBucket(GitSpindle):
             if self.use_credential_helper:
                 location = 'git\'s credential helper'
             print("Your BitBucket authentication password is now stored in %s" % location)
+            return
 
+        self.bb = bbapi.Bitbucket(user, password)
+        if self.use_cached_identity('%s:%s' % (user, password)):
+            return
         try:
-            self.bb = None
-            self.me = None
-            if not self.bb:
-                self.bb = bbapi.Bitbucket(user, password)
-            if not self.me:
-                self.me = self.bb.user(user)
-            self.my_login = self.me.username
+            self.fetch_identity()
             return
         except bbapi.BitBucketAuthenticationError:
             self.config('password', None)
 
         self.login()
 
+    def get_identity(self):
+        me = self.bb.user(self.bb.username)
+        return me, {'login': me.username, 'id': me.data.get('uuid'), 'scopes': None}
+
+    def is_auth_error(self, exc):
+        return isinstance(exc, bbapi.BitBucketAuthenticationError)
+
     def parse_url(self, url):
         return ([self.my_login] + url.path.split('/'))[-2:]
 
+    def index_all_repos(self):
+        return self.me.repositories()
+
+    def index_repo(self, repo):
+        attributes = dict((attr, getattr(repo, attr, None)) for attr in ('name', 'full_name', 'scm', 'description', 'is_private'))
+        attributes['data'] = {}
+        if 'parent' in repo.data:
+            attributes['data']['parent'] = {'full_name': repo.data['parent']['full_name']}
+        return repo.full_name, repo.owner['username'], attributes
+
+    def index_issues(self, repo, since):
+        # Bitbucket's query language can't compare with the exact timestamps
+        # it sends, so ask for everything updated on or after that day
+        query = since and 'updated_on >= %s' % since[:10]
+        try:
+            issues = [('issue', issue, issue.content['raw']) for issue in repo.issues(query)]
+        except bbapi.BitBucketError:
+            # No issue tracker
+            issues = []
+        issues += [('pull', pr, pr.description) for pr in repo.pull_requests(('OPEN', 'MERGED', 'DECLINED', 'SUPERSEDED'), query)]
+        return [(kind, issue.id, issue.state, issue.title, body, issue.updated_on,
+                 {'id': issue.id, 'title': issue.title, 'html_url': issue.html_url})
+                for (kind, issue, body) in issues if not since or issue.updated_on >= since]
+
+    def index_members(self, repo):
+        try:
+            return [(priv['user']['username'], priv['privilege']) for priv in repo.privileges()]
+        except bbapi.BitBucketError:
+            pass
+
     def get_repo(self, remote, user, repo):
         try:
             return self.bb.repository(user, repo)
         except bbapi.BitBucketError:
             pass
 
+    def repo_metadata(self, repo):
+        attributes = dict((attr, getattr(repo, attr, None)) for attr in ('name', 'slug', 'full_name', 'scm', 'is_private', 'is_fork'))
+        attributes['owner'] = {'username': repo.owner['username']}
+        attributes['links'] = {'html': {'href': repo.links['html']['href']}, 'clone': dict(repo.links['clone'])}
+        if attributes['is_fork']:
+            attributes['fork_of'] = {'owner': repo.fork_of['owner'], 'slug': repo.fork_of['slug']}
+        return repo.full_name, attributes
+
+    def lean_repo(self, attributes):
+        return bbapi.Repository(self.bb, mode=None, full_name=attributes['full_name'], _lean=True)
+
+    def refetch_repo(self, attributes):
+        try:
+            return self.bb.repository(*attributes['full_name'].split('/', 1))
+        except bbapi.BitBucketError:
+            pass
+
     def parent_repo(self, repo):
         if getattr(repo, 'is_fork', None):
             return self.bb.repository(repo.fork_of['owner'], repo.fork_of['slug'])
@@ -96,6 +147,12 @@ class BitBucket(GitSpindle):
     def api_root(self):
         return 'https://bitbucket.org/api/'
 
+    def api_server(self):
+        return 'https://api.bitbucket.org/'
+
+    def budget(self):
+        return self.bb.budget(self.api_server())
+
     # Commands
     @command
     def add_deploy_key(self, opts):
@@ -210,7 +267,7 @@ class BitBucket(GitSpindle):
                 sys.exit(1)
         # Fetch PR if needed
         pull_ref = 'refs/remotes/%s/pull-requests/%d' % (opts['--parent'] and 'upstream' or 'origin', pr.id)
-        sha = self.git('rev-parse', '--verify', '--quiet', pull_ref).stdout.strip()
+        sha = self.rev_parse(pull_ref)
         if not sha.startswith(pr.source['commit']['hash']):
             print('Fetching pull request')
             url = self.bb.repository(*pr.source['repository']['full_name'].split('/')).links['clone']['https']
@@ -221,13 +278,15 @@ class BitBucket(GitSpindle):
             for remote_ref in remote_refs:
                 self.gitm('fetch', url, remote_ref, redirect=False)
                 self.git('update-ref', pull_ref, pr.source['commit']['hash'])
-                sha = self.git('rev-parse', '--verify', '--quiet', pull_ref).stdout.strip()
+                sha = self.rev_parse(pull_ref)
                 if sha.startswith(pr.source['commit']['hash']):
                     break
         if not sha.startswith(pr.source['commit']['hash']):
             err("Cannot find pull request commit in current heads and tags")
-        head_sha = self.gitm('rev-parse', '--verify', '--quiet', 'HEAD').stdout.strip()
-        merge_base = self.git('merge-base', pr.source['commit']['hash'], head_sha).stdout.strip()
+        head_sha = self.rev_parse('HEAD')
+        if not head_sha:
+            err("Unable to find the current commit")
+        merge_base = self.merge_base(pr.source['commit']['hash'], head_sha)
         if merge_base.startswith(pr.source['commit']['hash']):
             print("Pull request was already merged into this history")
         elif merge_base == head_sha:
@@ -241,6 +300,7 @@ class BitBucket(GitSpindle):
     def browse(self, opts):
         """[--parent] [--no-browser] [<repo>] [<section>]
            Open the GitHub page for a repository in a browser"""
+        import webbrowser
         sections = ['src', 'commits', 'branches', 'pull-requests', 'downloads', 'admin', 'issues', 'wiki']
         if opts['<repo>'] in sections and not opts['<section>']:
             opts['<repo>'], opts['<section>'] = None, opts['<repo>']
@@ -248,7 +308,7 @@ class BitBucket(GitSpindle):
         url = repo.links['html']['href']
         if opts['<section>']:
             url += '/' + opts['<section>']
-        if opts['--no-browser'] or self.git('config', '--bool', 'gitspindle.no-browser').stdout.strip() == 'true':
+        if opts['--no-browser'] or self.git_config_bool('gitspindle.no-browser'):
             print('Please open the URL %s in your browser' % url)
         else:
             webbrowser.open_new(url)
@@ -453,37 +513,57 @@ class BitBucket(GitSpindle):
 
     @command
     def issues(self, opts):
-        """[<repo>] [--parent] [<query>]
+        """[<repo>] [--parent] [--cached] [--search=<words>] [<query>]
            List issues in a repository"""
         if opts['<repo>'] and not opts['<query>'] and '=' in opts['<repo>']:
             # Let's assume it's a query
             opts['<query>'] = opts['<repo>']
             opts['<repo>'] = None
-        if not opts['<repo>'] and not self.in_repo:
-            repos = self.me.repositories()
+        cache = self.repo_cache()
+
+        if opts['--cached'] or opts['--search']:
+            if opts['<query>']:
+                err('Queries can not be used with the local index')
+            names = None
+            if opts['<repo>'] or self.in_repo:
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repo = self.repository(tmpOpts)
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                names = [repo.full_name]
+            closed = ['resolved', 'invalid', 'duplicate', 'wontfix', 'closed', 'merged', 'declined', 'superseded']
+            found = self.cached_issues(names, closed=closed, search=opts['--search'])
         else:
-            # the parent is already retrieved in the for loop below
-            # without this, you get the grandparent instead if there is one
-            tmpOpts = dict(opts)
-            tmpOpts['--parent'] = False
-            repos = [self.repository(tmpOpts)]
-        for repo in repos:
-            repo = (opts['--parent'] and self.parent_repo(repo)) or repo
+            if not opts['<repo>'] and not self.in_repo:
+                repos = self.me.repositories()
+            else:
+                # the parent is already retrieved in the for loop below
+                # without this, you get the grandparent instead if there is one
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repos = [self.repository(tmpOpts)]
             query = opts['<query>']
             if query:
                 if not 'state' in query:
                     query = '(state != "resolved" AND state != "invalid" AND state != "duplicate" AND state != "wontfix" AND state != "closed") AND (%s)' % query
             else:
                 query = 'state != "resolved" AND state != "invalid" AND state != "duplicate" AND state != "wontfix" AND state != "closed"'
-            try:
-                issues = repo.issues(query)
-            except bbapi.BitBucketError:
-                issues = None
-            try:
-                pullrequests = repo.pull_requests()
-            except bbapi.BitBucketError:
-                pullrequests = None
 
+            def fetch(repo):
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                try:
+                    issues = repo.issues(query)
+                except bbapi.BitBucketError:
+                    issues = None
+                try:
+                    pullrequests = repo.pull_requests()
+                except bbapi.BitBucketError:
+                    pullrequests = None
+                return repo, issues, pullrequests
+
+            found = self.for_each(fetch, repos)
+
+        for repo, issues, pullrequests in found:
             if issues:
                 print(wrap("Issues for %s" % repo.full_name, attr.bright))
                 for issue in issues:
@@ -529,7 +609,7 @@ class BitBucket(GitSpindle):
            Mirror a repository, or all repositories for a user"""
         if opts['<repo>'] and opts['<repo>'].endswith('/*'):
             user = opts['<repo>'].rsplit('/', 2)[-2]
-            for repo in self.bb.user(user).repositories():
+            for repo in self.bb.user(user).repositories(fields=('full_name',)):
                 opts['<repo>'] = repo.full_name
                 self.mirror(opts)
             return
@@ -642,7 +722,7 @@ class BitBucket(GitSpindle):
 
         # Do we have the dst locally?
         for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+            url = self.git_config('remote.%s.url' % remote)
             if url in parent.links['clone'].values():
                 if parent.is_private and url != parent.links['clone']['ssh']:
                     err("You should configure %s to fetch via ssh, it is a private repo" % parent.full_name)
@@ -724,15 +804,21 @@ class BitBucket(GitSpindle):
 
     @command
     def repos(self, opts):
-        """[--no-forks] [<user>]
+        """[--no-forks] [--cached] [<user>]
            List all repos of a user, by default yours"""
-        try:
-            repos = self.bb.user(opts['<user>'] or self.my_login).repositories()
-        except bbapi.BitBucketError:
-            if 'is a team account' in str(sys.exc_info()[1]):
-                repos = self.bb.team(opts['<user>']).repositories()
-            else:
-                raise
+        repos = []
+        repos_fields = ('name', 'scm', 'description', 'is_private', 'parent.full_name')
+        for user in opts['<user>'] or [self.my_login]:
+            if opts['--cached']:
+                repos += self.cached_repos(user)
+                continue
+            try:
+                repos += self.bb.user(user).repositories(fields=repos_fields)
+            except bbapi.BitBucketError:
+                if 'is a team account' in str(sys.exc_info()[1]):
+                    repos += self.bb.team(user).repositories(fields=repos_fields)
+                else:
+                    raise
         if not repos:
             return
         maxlen = max([len(x.name) for x in repos])
@@ -755,9 +841,10 @@ class BitBucket(GitSpindle):
         tmpOpts['--root'] = False
         repo = self.repository(tmpOpts)
         root = self.repository(opts)
-        self.gitm('config', 'goblet.owner', root.owner['display_name'] or root.owner['username'])
-        self.gitm('config', 'goblet.cloneurlhttp', repo.links['clone']['https'])
-        self.gitm('config', 'goblet.cloneurlssh', repo.links['clone']['ssh'])
+        with self.config_transaction() as config:
+            config.set('goblet.owner', root.owner['display_name'] or root.owner['username'])
+            config.set('goblet.cloneurlhttp', repo.links['clone']['https'])
+            config.set('goblet.cloneurlssh', repo.links['clone']['ssh'])
         if repo.description:
             with open(os.path.join(self.gitm('rev-parse', '--git-dir').stdout.strip(), 'description'), 'w') as fd:
                 fd.write(repo.description)
@@ -776,19 +863,20 @@ class BitBucket(GitSpindle):
                 except bbapi.BitBucketError:
                     pass
 
-        url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
-            print("Pointing %s to %s" % (remote, url))
-            self.gitm('config', 'remote.%s.url' % remote, url)
-        self.gitm('config', '--replace-all', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
-
-        if repo.is_fork:
-            parent = self.bb.repository(repo.fork_of['owner'], repo.fork_of['slug'])
-            url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
-                print("Pointing upstream to %s" % url)
-                self.gitm('config', 'remote.upstream.url', url)
-            self.gitm('config', 'remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
+        with self.config_transaction() as config:
+            url = self.clone_url(repo, opts)
+            if self.git_config('remote.%s.url' % remote) != url:
+                print("Pointing %s to %s" % (remote, url))
+                config.set('remote.%s.url' % remote, url)
+            config.replace_all('remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
+
+            if repo.is_fork:
+                parent = self.bb.repository(repo.fork_of['owner'], repo.fork_of['slug'])
+                url = self.clone_url(parent, opts)
+                if self.git_config('remote.upstream.url') != url:
+                    print("Pointing upstream to %s" % url)
+                    config.set('remote.upstream.url', url)
+                config.set('remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
 
         if self.git('ls-remote', remote).stdout.strip():
             self.gitm('fetch', '--prune', '--tags', remote, redirect=False)
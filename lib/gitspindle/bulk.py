@@ -0,0 +1,19 @@
+# Doing the same thing for many repositories
+#
+# Commands that operate on all repositories of a user do at least one request
+# per repository. map() does those concurrently in a few threads, see
+# gitspindle.pages, and returns the results in order.
+
+import gitspindle.pages as pages
+import gitspindle.ratelimit as ratelimit
+
+# Maximum number of requests in flight per host
+CONCURRENCY = 8
+
+def map(func, items, url, budget=None, concurrency=CONCURRENCY):
+    """Like map(func, items), where func does requests to the host of url.
+       budget is the rate limit budget those requests use. Results are
+       yielded in order, as soon as they are available"""
+    concurrency = min(concurrency, ratelimit.MAX_CONCURRENCY)
+    workers = budget.workers(concurrency) if budget is not None else concurrency
+    return pages.fetch(func, items, workers)
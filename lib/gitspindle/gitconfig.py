@@ -0,0 +1,251 @@
+# Editing git config files without spawning a git process per change
+#
+# Changes are applied to a parsed copy of the file and written in one go,
+# using the same lockfile protocol as git: the new contents are written to
+# <file>.lock, which is then renamed over the original file.
+
+import io
+import os
+import random
+import re
+import time
+
+section_re = re.compile(r'\s*\[\s*([-.A-Za-z0-9]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+variable_re = re.compile(r'\s*([A-Za-z][-A-Za-z0-9]*)')
+# Python 2 has no os.replace, but rename replaces atomically on POSIX
+replace = getattr(os, 'replace', os.rename)
+
+class ConfigError(Exception):
+    pass
+
+class LockError(ConfigError):
+    pass
+
+def split_key(key):
+    """Split a key into section, subsection (or None) and name"""
+    section, _, key = key.partition('.')
+    subsection, _, name = key.rpartition('.')
+    if not section or not name:
+        raise ConfigError("Invalid key: %s" % key)
+    return section, subsection or None, name
+
+def format_value(value):
+    value = str(value)
+    quote = value != value.strip() or ';' in value or '#' in value
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t')
+    return '"%s"' % value if quote else value
+
+def decode(text):
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
+def format_section(section, subsection):
+    if subsection is None:
+        return '[%s]\n' % section
+    return '[%s "%s"]\n' % (section, subsection.replace('\\', '\\\\').replace('"', '\\"'))
+
+def continues(text, quoted=False):
+    """Whether a (partial) config line is continued on the next line. Returns
+       that and whether we are inside a quoted string at the end of the line"""
+    escaped = False
+    for char in text.rstrip('\r\n'):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char in ';#' and not quoted:
+            return False, quoted
+    return escaped, quoted
+
+class ConfigFile(object):
+    """A git config file that is changed under a lock and written atomically.
+       Lock it, make changes, write and then commit or rollback."""
+    def __init__(self, path, private=False):
+        self.path = os.path.realpath(path)
+        self.lockfile = self.path + '.lock'
+        self.private = private
+        self.fd = None
+        self.locked = False
+        self.original = None
+        self.retries = 0
+
+    def parse(self, text):
+        # Items are [section, name, text], where section is (section, subsection)
+        # for all lines that belong to a section. Name is None for lines that
+        # are not variables. Variables that are added later become items too,
+        # written after the item in after, or in a new section.
+        self.items = []
+        self.sections = {}
+        self.variables = {}
+        self.after = {}
+        self.new_sections = []
+        self.new_section_index = {}
+        section = None
+        lines = text.splitlines(True)
+        num = 0
+        while num < len(lines):
+            line = lines[num]
+            num += 1
+            match = section_re.match(line)
+            if match:
+                name, subsection = match.groups()
+                if subsection is not None:
+                    subsection = re.sub(r'\\(.)', r'\1', subsection)
+                elif '.' in name:
+                    # Deprecated [section.subsection] syntax
+                    name, subsection = name.split('.', 1)
+                    subsection = subsection.lower()
+                section = (name.lower(), subsection)
+                self.sections[section] = len(self.items)
+                self.items.append([section, None, line])
+                continue
+            match = variable_re.match(line)
+            if not match or section is None or line.lstrip()[0] in ';#':
+                self.items.append([section, None, line])
+                continue
+            rest = line[match.end():].lstrip()
+            more, quoted = continues(rest[1:]) if rest.startswith('=') else (False, False)
+            while more and num < len(lines):
+                line += lines[num]
+                more, quoted = continues(lines[num], quoted)
+                num += 1
+            key = (section, match.group(1).lower())
+            self.variables.setdefault(key, []).append(len(self.items))
+            self.sections[section] = len(self.items)
+            self.items.append([section, match.group(1), line])
+        self.parsed = len(self.items)
+
+    def _existing(self, key):
+        section, subsection, name = split_key(key)
+        section = (section.lower(), subsection)
+        return section, [idx for idx in self.variables.get((section, name.lower()), []) if self.items[idx] is not None]
+
+    def _append(self, key, value):
+        section, subsection, name = split_key(key)
+        section_id = (section.lower(), subsection)
+        idx = len(self.items)
+        self.items.append([section_id, name, '\t%s = %s\n' % (name, format_value(value))])
+        self.variables.setdefault((section_id, name.lower()), []).append(idx)
+        if section_id in self.sections:
+            self.after.setdefault(self.sections[section_id], []).append(idx)
+        elif section_id in self.new_section_index:
+            self.new_section_index[section_id].append(idx)
+        else:
+            self.new_section_index[section_id] = [section_id, format_section(section, subsection), idx]
+            self.new_sections.append(self.new_section_index[section_id])
+
+    def _replace(self, idx, key, value):
+        name = split_key(key)[2]
+        self.items[idx][2] = '\t%s = %s\n' % (name, format_value(value))
+
+    def set(self, key, value):
+        """Like git config <key> <value>"""
+        existing = self._existing(key)[1]
+        if len(existing) > 1:
+            raise ConfigError("%s has multiple values" % key)
+        if existing:
+            self._replace(existing[0], key, value)
+        else:
+            self._append(key, value)
+
+    def add(self, key, value):
+        """Like git config --add <key> <value>"""
+        self._append(key, value)
+
+    def replace_all(self, key, value):
+        """Like git config --replace-all <key> <value>"""
+        existing = self._existing(key)[1]
+        if not existing:
+            return self._append(key, value)
+        self._replace(existing[0], key, value)
+        for idx in existing[1:]:
+            self.items[idx] = None
+
+    def unset(self, key):
+        """Like git config --unset <key>, but not an error if the key is not set"""
+        existing = self._existing(key)[1]
+        if len(existing) > 1:
+            raise ConfigError("%s has multiple values" % key)
+        for idx in existing:
+            self.items[idx] = None
+
+    def unset_all(self, key):
+        """Like git config --unset-all <key>"""
+        for idx in self._existing(key)[1]:
+            self.items[idx] = None
+
+    def _lines(self, indices):
+        return [self.items[idx][2] for idx in indices if self.items[idx] is not None]
+
+    def text(self):
+        text = []
+        for idx in range(self.parsed):
+            text.extend(self._lines([idx] + self.after.get(idx, [])))
+        for new_section in self.new_sections:
+            text.append(new_section[1])
+            text.extend(self._lines(new_section[2:]))
+        for num, line in enumerate(text[:-1]):
+            if not line.endswith('\n'):
+                text[num] = line + '\n'
+        return ''.join(text)
+
+    def lock(self, timeout=0):
+        """Take the lock and read the current contents. If another process
+           holds the lock, keep trying with exponential backoff until timeout
+           seconds have passed and then raise LockError"""
+        deadline = time.time() + timeout
+        delay = 0.01
+        while True:
+            try:
+                return self._lock()
+            except LockError:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise
+                # Jitter, so processes that collided don't collide again
+                time.sleep(min(delay * random.uniform(0.5, 1.5), remaining))
+                delay = min(delay * 2, 1)
+                self.retries += 1
+
+    def _lock(self):
+        if os.path.exists(self.path):
+            mode = os.stat(self.path).st_mode & 0o777
+        else:
+            mode = 0o600 if self.private else 0o666
+        try:
+            self.fd = os.open(self.lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        except OSError as e:
+            if os.path.exists(self.lockfile):
+                raise LockError("Unable to lock %s: %s" % (self.path, e.strerror))
+            raise ConfigError("Unable to lock %s: %s" % (self.path, e.strerror))
+        self.locked = True
+        self.original = ''
+        if os.path.exists(self.path):
+            with io.open(self.path, encoding='utf-8', newline='') as fd:
+                self.original = fd.read()
+        self.parse(self.original)
+
+    def write(self):
+        with io.open(self.fd, 'w', encoding='utf-8', newline='') as fd:
+            self.fd = None
+            fd.write(decode(self.text()))
+
+    def commit(self):
+        replace(self.lockfile, self.path)
+        self.locked = False
+
+    def rollback(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.locked:
+            self.locked = False
+            os.unlink(self.lockfile)
+
+    def restore(self):
+        """Undo a commit"""
+        with io.open(self.path, 'w', encoding='utf-8', newline='') as fd:
+            fd.write(decode(self.original))
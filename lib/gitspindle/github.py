@@ -2,33 +2,30 @@ from gitspindle import *
 from gitspindle.ansi import *
 import datetime
 import getpass
-import github3
-import github3.gists
 import glob
 import os
 import re
-import requests
-import socket
 import sys
 import tempfile
 import time
-import webbrowser
 
 class GitHub(GitSpindle):
     prog = 'git hub'
     what = 'GitHub'
     spindle = 'github'
     hosts = ['github.com', 'www.github.com', 'gist.github.com']
-    api = github3
 
     def __init__(self):
         super(GitHub, self).__init__()
         if self.use_credential_helper:
             # Git Credential Manager creates a token with too few scopes
-            self.use_credential_helper = self.git('config', 'credential.helper').stdout.strip() != 'manager'
+            self.use_credential_helper = self.git_config('credential.helper') != 'manager'
 
     # Support functions
     def login(self, password=None):
+        import github3
+        import gitspindle.github3monkey
+        import socket
         host = self.config('host')
         if host and host not in ('https://api.github.com', 'api.github.com'):
             if not host.startswith(('http://', 'https://')):
@@ -36,6 +33,9 @@ class GitHub(GitSpindle):
             self.gh = github3.GitHubEnterprise(url=host)
         else:
             self.gh = github3.GitHub()
+        # Use the shared connection pool, which may have been warmed up
+        import gitspindle.transport as transport
+        transport.get(self.gh._session.base_url).share(self.gh._session)
 
         user = None
         token = None
@@ -94,8 +94,9 @@ class GitHub(GitSpindle):
             if auth is None:
                 err("Authentication failed")
             token = auth.token
-            self.config('token', token)
-            self.config('auth-id', auth.id)
+            with self.config_transaction():
+                self.config('token', token)
+                self.config('auth-id', auth.id)
             location = '%s - do not share this file' % self.config_file
             if self.use_credential_helper:
                 location = 'git\'s credential helper'
@@ -105,10 +106,10 @@ class GitHub(GitSpindle):
         if not token:
             err("No token specified")
         self.gh.login(token=token)
+        if self.use_cached_identity(token):
+            return
         try:
-            self.me = self.gh.user()
-            self.my_login = self.me.login
-            self.config('user', self.my_login)
+            self.fetch_identity()
             return
         except github3.GitHubError:
             if sys.exc_info()[1].code != 401:
@@ -120,6 +121,95 @@ class GitHub(GitSpindle):
         # Try Token as password
         self.login(token)
 
+    def get_identity(self):
+        import github3.users
+        response = self.gh._get(self.gh._build_url('user'))
+        me = github3.users.User(self.gh._json(response, 200), self.gh._session)
+        scopes = [scope.strip() for scope in response.headers.get('X-OAuth-Scopes', '').split(',') if scope.strip()]
+        return me, {'login': me.login, 'id': me.id, 'scopes': scopes}
+
+    def is_auth_error(self, exc):
+        import github3
+        return isinstance(exc, github3.GitHubError) and exc.code == 401
+
+    def graphql(self, query, **variables):
+        """Run a GraphQL query. Returns None if that fails, for example on
+           GitHub Enterprise versions without GraphQL"""
+        import gitspindle.jsoncodec as jsoncodec
+        url = re.sub(r'/v3/?$', '', self.gh._session.base_url) + '/graphql'
+        response = self.gh._post(url, data={'query': query, 'variables': variables})
+        if response.status_code != 200:
+            return None
+        try:
+            data = jsoncodec.loads(response.content)
+        except ValueError:
+            return None
+        if data.get('errors'):
+            return None
+        return data.get('data')
+
+    lean_repos_query = """
+        query($login: String!, $cursor: String) {
+            repositoryOwner(login: $login) {
+                repositories(first: 100, after: $cursor, ownerAffiliations: [OWNER], privacy: PUBLIC, orderBy: {field: NAME, direction: ASC}) {
+                    ...repos
+                }
+            }
+        }"""
+    lean_my_repos_query = """
+        query($cursor: String) {
+            repositoryOwner: viewer {
+                repositories(first: 100, after: $cursor, affiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER], orderBy: {field: NAME, direction: ASC}) {
+                    ...repos
+                }
+            }
+        }"""
+    lean_repos_fragment = """
+        fragment repos on RepositoryConnection {
+            pageInfo { hasNextPage endCursor }
+            nodes {
+                name nameWithOwner owner { login } description isPrivate isFork
+                forkCount stargazers { totalCount }
+            }
+        }"""
+
+    def lean_repos(self, user=None):
+        """The repositories of a user (by default, yours, including those of
+           organizations you're in) with only the fields git hub repos needs.
+           Returns None if they can't be fetched like that"""
+        import github3.repos
+        query = self.lean_my_repos_query if user is None else self.lean_repos_query
+        query += self.lean_repos_fragment
+        api = self.gh._session.base_url
+        repos = []
+        cursor = None
+        while True:
+            if user is None:
+                data = self.graphql(query, cursor=cursor)
+            else:
+                data = self.graphql(query, login=user, cursor=cursor)
+            if not data or not data.get('repositoryOwner'):
+                return None
+            connection = data['repositoryOwner']['repositories']
+            for node in connection['nodes']:
+                stars = node['stargazers']['totalCount']
+                repos.append(github3.repos.Repository({
+                    'name': node['name'],
+                    'full_name': node['nameWithOwner'],
+                    'owner': node['owner'],
+                    'description': node['description'],
+                    'private': node['isPrivate'],
+                    'fork': node['isFork'],
+                    'forks': node['forkCount'],
+                    'forks_count': node['forkCount'],
+                    'stargazers_count': stars,
+                    'watchers': stars,
+                    'url': '%s/repos/%s' % (api, node['nameWithOwner']),
+                }, self.gh))
+            if not connection['pageInfo']['hasNextPage']:
+                return repos
+            cursor = connection['pageInfo']['endCursor']
+
     def parse_url(self, url):
         if url.hostname == 'gist.github.com':
             return ['gist', url.path.split('/')[-1]]
@@ -137,6 +227,63 @@ class GitHub(GitSpindle):
 
         return repo_
 
+    def repo_metadata(self, repo):
+        import github3.gists
+        if isinstance(repo, github3.gists.Gist):
+            return None
+        attributes = dict((attr, getattr(repo, attr)) for attr in ('id', 'name', 'full_name', 'default_branch', 'private',
+                          'fork', 'html_url', 'clone_url', 'ssh_url', 'git_url'))
+        attributes['owner'] = {'login': repo.owner.login}
+        attributes['url'] = repo._api
+        return repo.full_name, attributes
+
+    def lean_repo(self, attributes):
+        import github3.repos
+        return github3.repos.Repository(attributes, self.gh)
+
+    def refetch_repo(self, attributes):
+        return self.gh.repository(attributes['owner']['login'], attributes['name'])
+
+    def index_all_repos(self):
+        return list(self.gh.iter_repos(type='all'))
+
+    def index_repo(self, repo):
+        attributes = dict((attr, getattr(repo, attr)) for attr in ('name', 'full_name', 'description', 'private', 'fork',
+                          'forks', 'watchers'))
+        attributes['owner'] = {'login': repo.owner.login}
+        attributes['_json_data'] = {'stargazers_count': repo._json_data['stargazers_count']}
+        return repo.full_name, repo.owner.login, attributes
+
+    def index_issues(self, repo, since):
+        import github3
+        try:
+            issues = list(repo.iter_issues(state='all', since=since))
+        except github3.GitHubError:
+            if sys.exc_info()[1].code == 410:
+                # Issues are disabled
+                return []
+            raise
+        return [(issue.pull_request and 'pull' or 'issue', issue.number, issue.state, issue.title, issue.body,
+                 issue._json_data['updated_at'], {'number': issue.number, 'title': issue.title, 'html_url': issue.html_url,
+                 'pull_request': issue.pull_request and {'html_url': issue.pull_request['html_url']}})
+                for issue in issues]
+
+    def index_releases(self, repo):
+        return [(release.tag_name, release.name, release.body, release.html_url) for release in repo.iter_releases()]
+
+    def index_members(self, repo):
+        import github3
+        try:
+            collaborators = list(repo.iter_collaborators())
+        except github3.GitHubError:
+            return None
+        members = []
+        for user in collaborators:
+            permissions = user._json_data.get('permissions', {})
+            access = [perm for perm in ('admin', 'push', 'pull') if permissions.get(perm)]
+            members.append((user.login, access and access[0] or None))
+        return members
+
     def parent_repo(self, repo):
         if repo.fork:
             # In search results or lists parent info is not returned with a repository
@@ -161,6 +308,9 @@ class GitHub(GitSpindle):
             return 'https://api.github.com'
         return host.rstrip('/') + '/api/v3'
 
+    def budget(self):
+        return self.gh._session.budget()
+
     def find_template(self, repo, template):
         template = template.lower()
         contents = None
@@ -256,12 +406,14 @@ class GitHub(GitSpindle):
                 sys.exit(1)
         # Fetch PR if needed
         pull_ref = 'refs/remotes/%s/pull-requests/%d' % (opts['--parent'] and 'upstream' or 'origin', pr.number)
-        sha = self.git('rev-parse', '--verify', '--quiet', pull_ref).stdout.strip()
+        sha = self.rev_parse(pull_ref)
         if sha != pr.head.sha:
             print("Fetching pull request")
             self.gitm('fetch', repo.clone_url, 'refs/pull/%d/head:%s' % (pr.number, pull_ref), redirect=False)
-        head_sha = self.gitm('rev-parse', '--verify', '--quiet', 'HEAD').stdout.strip()
-        merge_base = self.git('merge-base', pr.head.sha, head_sha).stdout.strip()
+        head_sha = self.rev_parse('HEAD')
+        if not head_sha:
+            err("Unable to find the current commit")
+        merge_base = self.merge_base(pr.head.sha, head_sha)
         if merge_base == pr.head.sha:
             print("Pull request was already merged into this history")
         elif merge_base == head_sha:
@@ -351,6 +503,7 @@ class GitHub(GitSpindle):
     def browse(self, opts):
         """[--parent] [--no-browser] [<repo>] [<section>]
            Open the GitHub page for a repository in a browser"""
+        import webbrowser
         sections = ['issues', 'pulls', 'wiki', 'branches', 'releases', 'contributors', 'graphs', 'settings']
         if opts['<repo>'] in sections and not opts['<section>']:
             opts['<repo>'], opts['<section>'] = None, opts['<repo>']
@@ -358,7 +511,7 @@ class GitHub(GitSpindle):
         url = repo.html_url
         if opts['<section>']:
             url += '/' + opts['<section>']
-        if opts['--no-browser'] or self.git('config', '--bool', 'gitspindle.no-browser').stdout.strip() == 'true':
+        if opts['--no-browser'] or self.git_config_bool('gitspindle.no-browser'):
             print('Please open the URL %s in your browser' % url)
         else:
             webbrowser.open_new(url)
@@ -367,6 +520,7 @@ class GitHub(GitSpindle):
     def calendar(self, opts):
         """[<user>]
            Show a timeline of a user's activity"""
+        import requests
         user = (opts['<user>'] or [self.my_login])[0]
         months = []
         rows = [[],[],[],[],[],[],[]]
@@ -594,7 +748,7 @@ class GitHub(GitSpindle):
                 if file != 'CNAME':
                     error("The CNAME file must be named in all caps",
                           "https://help.github.com/articles/adding-a-cname-file-to-your-repository/")
-                cname = self.git('--no-pager', 'show', '%s:%s' % (ref, file)).stdout.strip()
+                cname = self.object_contents('%s:%s' % (ref, file)).strip()
                 pages_ips = self.gh.meta()['pages']
                 try:
                     import publicsuffix
@@ -660,6 +814,7 @@ class GitHub(GitSpindle):
     def collaborators(self, opts):
         """[<repo>]
            List collaborators of a repository"""
+        import github3
         repo = self.repository(opts)
         try:
             users = list(repo.iter_collaborators())
@@ -700,6 +855,9 @@ class GitHub(GitSpindle):
     def create_token(self, opts):
         """[--store]
            Create a personal access token that can be used for git operations"""
+        import github3
+        import gitspindle.github3monkey
+        import socket
         password = getpass.getpass("GitHub password: ")
         scopes = ['repo']
         name = "Git on %s" % socket.gethostname()
@@ -800,6 +958,7 @@ class GitHub(GitSpindle):
     def fork(self, opts):
         """[--ssh|--http|--git] [--triangular [--upstream-branch=<branch>]] [<repo>]
            Fork a repo and clone it"""
+        import github3.gists
         do_clone = bool(opts['<repo>'])
         repo = self.repository(opts)
         if repo.owner.login == self.my_login:
@@ -954,39 +1113,63 @@ class GitHub(GitSpindle):
 
     @command
     def issues(self, opts):
-        """[<repo>] [--parent] [<filter>...]
+        """[<repo>] [--parent] [--cached] [--search=<words>] [<filter>...]
            List issues in a repository"""
+        import github3
+        import github3.repos
         if opts['<repo>'] and '=' in opts['<repo>']:
             # Let's assume it's a filter
             opts['<filter>'].insert(0, opts['<repo>'])
             opts['<repo>'] = None
-        if not opts['<repo>'] and not self.in_repo:
-            repos = list(self.gh.iter_repos(type='all'))
+        if any([not '=' in x for x in opts['<filter>']]):
+            err('<filter> must be an equals sign separated key-value pair')
+        filters = dict([x.split('=', 1) for x in opts['<filter>']])
+        iter_issues = github3.repos.Repository.iter_issues
+        valid_filters = iter_issues.__code__.co_varnames[1:iter_issues.__code__.co_argcount]
+        if any([not x in valid_filters for x in filters]):
+            err('Invalid filter specified. Valid filters: "%s"' % '", "'.join(sorted(valid_filters)))
+        cache = self.repo_cache()
+
+        if opts['--cached'] or opts['--search']:
+            if set(filters) - set(['state']):
+                err('Only the state filter can be used with the local index')
+            names = None
+            if opts['<repo>'] or self.in_repo:
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repo = self.repository(tmpOpts)
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                names = ['%s/%s' % (repo.owner.login, repo.name)]
+            state = filters.get('state', 'open')
+            found = [(repo, issues + pulls, None) for (repo, issues, pulls)
+                     in self.cached_issues(names, state != 'all' and [state] or None, search=opts['--search'])]
         else:
-            # the parent is already retrieved in the for loop below
-            # without this, you get the grandparent instead if there is one
-            tmpOpts = dict(opts)
-            tmpOpts['--parent'] = False
-            repos = [self.repository(tmpOpts)]
-        for repo in repos:
-            repo = (opts['--parent'] and self.parent_repo(repo)) or repo
-            if any([not '=' in x for x in opts['<filter>']]):
-                err('<filter> must be an equals sign separated key-value pair')
-            filters = dict([x.split('=', 1) for x in opts['<filter>']])
-            valid_filters = repo.iter_issues.__code__.co_varnames[1:repo.iter_issues.__code__.co_argcount]
-            if any([not x in valid_filters for x in filters]):
-                err('Invalid filter specified. Valid filters: "%s"' % '", "'.join(sorted(valid_filters)))
-            try:
-                issues = list(repo.iter_issues(**filters))
-            except github3.GitHubError:
-                _, error, _ = sys.exc_info()
-                if error.code == 410:
-                    if len(repos) == 1:
-                        print(error.message)
-                    continue
-                else:
+            if not opts['<repo>'] and not self.in_repo:
+                repos = list(self.gh.iter_repos(type='all'))
+            else:
+                # the parent is already retrieved in the for loop below
+                # without this, you get the grandparent instead if there is one
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repos = [self.repository(tmpOpts)]
+
+            def fetch(repo):
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                try:
+                    return repo, list(repo.iter_issues(**filters)), None
+                except github3.GitHubError:
+                    _, error, _ = sys.exc_info()
+                    if error.code == 410:
+                        return repo, None, error
                     raise
 
+            found = self.for_each(fetch, repos)
+
+        for repo, issues, error in found:
+            if error:
+                if len(repos) == 1:
+                    print(error.message)
+                continue
             if any([not issue.pull_request for issue in issues]):
                 print(wrap("Issues for %s/%s" % (repo.owner.login, repo.name), attr.bright))
                 for issue in issues:
@@ -1335,7 +1518,7 @@ class GitHub(GitSpindle):
 
         # Do we have the dst locally?
         for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+            url = self.git_config('remote.%s.url' % remote)
             if url in [parent.git_url, parent.ssh_url, parent.clone_url]:
                 if parent.private and url != parent.ssh_url:
                     err("You should configure %s/%s to fetch via ssh, it is a private repo" % (parent.owner.login, parent.name))
@@ -1432,10 +1615,9 @@ class GitHub(GitSpindle):
             tag = tag[10:]
         name = opts['<releasename>'] or tag
         ref = 'refs/tags/' + tag
-        ret = self.git('rev-parse', '--quiet', '--verify', ref + '^0')
-        if not ret:
+        sha = self.rev_parse(ref + '^0')
+        if not sha:
             err("Tag %s does not exist yet" % tag)
-        sha = ret.stdout.strip()
         if not self.git('ls-remote', repo.remote, ref).stdout.strip():
             if self.question("Tag %s does not exist in your GitHub repo, shall I push?" % tag):
                 self.gitm('push', repo.remote, '%s:%s' % (ref, ref), redirect=False)
@@ -1444,7 +1626,7 @@ class GitHub(GitSpindle):
         if not found:
             edit = True
             body = ''
-            if self.git('cat-file', '-t', ref).stdout.strip() == 'tag':
+            if self.object_type(ref) == 'tag':
                 body = self.git('log', '-1', '--pretty=format:%B', ref).stdout
             body += """
 # Creating release %s based on tag %s
@@ -1521,6 +1703,7 @@ class GitHub(GitSpindle):
     def render(self, opts):
         """[--save=<outfile>|--no-browser] <file>
            Render a markdown document"""
+        import webbrowser
         template = """<!DOCTYPE html>
 <html>
   <head>
@@ -1554,7 +1737,7 @@ class GitHub(GitSpindle):
                 fd.write(html.encode('utf-8'))
                 fd.close()
                 url = 'file://' + fd.name
-                if opts['--no-browser'] or self.git('config', '--bool', 'gitspindle.no-browser').stdout.strip() == 'true':
+                if opts['--no-browser'] or self.git_config_bool('gitspindle.no-browser'):
                     print('Please open the URL %s in your browser' % url)
                 else:
                     webbrowser.open(url)
@@ -1563,12 +1746,19 @@ class GitHub(GitSpindle):
 
     @command
     def repos(self, opts):
-        """[--no-forks] [<user>]
+        """[--no-forks] [--cached] [<user>]
            List all repos of a user, by default yours"""
-        if opts['<user>']:
-            repos = list(self.gh.iter_user_repos(opts['<user>'][0]))
+        if opts['--cached']:
+            repos = self.cached_repos(opts['<user>'] and opts['<user>'][0])
+            opts['<user>'] = opts['<user>'] or [self.my_login]
+        elif opts['<user>']:
+            repos = self.lean_repos(opts['<user>'][0])
+            if repos is None:
+                repos = list(self.gh.iter_user_repos(opts['<user>'][0]))
         else:
-            repos = list(self.gh.iter_repos(type='all'))
+            repos = self.lean_repos()
+            if repos is None:
+                repos = list(self.gh.iter_repos(type='all'))
             opts['<user>'] = [self.my_login]
         if not repos:
             return
@@ -1614,10 +1804,11 @@ class GitHub(GitSpindle):
         repo = self.repository(tmpOpts)
         root = self.repository(opts)
         owner = self.gh.user(root.owner.login)
-        self.gitm('config', 'goblet.owner', owner.name or owner.login)
-        self.gitm('config', 'goblet.cloneurlgit', repo.git_url)
-        self.gitm('config', 'goblet.cloneurlhttp', repo.clone_url)
-        self.gitm('config', 'goblet.cloneurlssh', repo.ssh_url)
+        with self.config_transaction() as config:
+            config.set('goblet.owner', owner.name or owner.login)
+            config.set('goblet.cloneurlgit', repo.git_url)
+            config.set('goblet.cloneurlhttp', repo.clone_url)
+            config.set('goblet.cloneurlssh', repo.ssh_url)
         if repo.description:
             with open(os.path.join(self.gitm('rev-parse', '--git-dir').stdout.strip(), 'description'), 'w') as fd:
                 fd.write(repo.description)
@@ -1635,21 +1826,22 @@ class GitHub(GitSpindle):
                 if my_repo:
                     repo = my_repo
 
-        url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
-            print("Pointing %s to %s" % (remote, url))
-            self.gitm('config', 'remote.%s.url' % remote, url)
-        self.gitm('config', '--replace-all', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
-        self.gitm('config', '--add', 'remote.%s.fetch' % remote, '+refs/pull/*/head:refs/remotes/%s/pull-requests/*' % remote)
+        with self.config_transaction() as config:
+            url = self.clone_url(repo, opts)
+            if self.git_config('remote.%s.url' % remote) != url:
+                print("Pointing %s to %s" % (remote, url))
+                config.set('remote.%s.url' % remote, url)
+            config.replace_all('remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
+            config.add('remote.%s.fetch' % remote, '+refs/pull/*/head:refs/remotes/%s/pull-requests/*' % remote)
 
-        if repo.fork:
-            parent = self.parent_repo(repo)
-            url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
-                print("Pointing upstream to %s" % url)
-                self.gitm('config', 'remote.upstream.url', url)
-            self.gitm('config', '--replace-all', 'remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
-            self.gitm('config', '--add', 'remote.upstream.fetch', '+refs/pull/*/head:refs/remotes/upstream/pull-requests/*')
+            if repo.fork:
+                parent = self.parent_repo(repo)
+                url = self.clone_url(parent, opts)
+                if self.git_config('remote.upstream.url') != url:
+                    print("Pointing upstream to %s" % url)
+                    config.set('remote.upstream.url', url)
+                config.replace_all('remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
+                config.add('remote.upstream.fetch', '+refs/pull/*/head:refs/remotes/upstream/pull-requests/*')
 
         if self.git('ls-remote', remote).stdout.strip():
             self.gitm('fetch', '--prune', '--tags', remote, redirect=False)
@@ -1664,6 +1856,7 @@ class GitHub(GitSpindle):
     @command
     def status(self, opts):
         """\nDisplay current and historical GitHub service status"""
+        import github3
         api = github3.GitHubStatus()
         messages = api.messages()
         if not messages:
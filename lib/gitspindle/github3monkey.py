@@ -0,0 +1,187 @@
+# Set the spindle attribute
+import github3.gists
+import github3.repos
+github3.gists.Gist.spindle = 'github'
+github3.repos.Repository.spindle = 'github'
+
+# Monkeypatch github3.gists.Gist to behave more like a repo
+github3.gists.Gist.ssh_url = property(lambda self: self.git_pull_url.replace('https://', 'git@', 1).replace('http://', 'git@', 1).replace('/', ':/', 1))
+github3.gists.Gist.clone_url = property(lambda self: self.git_pull_url)
+github3.gists.Gist.git_url = property(lambda self: self.git_pull_url.replace('https://', 'git://', 1).replace('http://', 'git://', 1))
+github3.gists.Gist.name = property(lambda self: self.id)
+github3.gists.Gist.private = property(lambda self: not self.public)
+github3.gists.Gist.create_fork = github3.gists.Gist.fork
+# XXX - There is nothing in the API output that indicates forkedness
+github3.gists.Gist.fork = False
+github3.gists.Gist.iter_issues = lambda self, *args, **kwargs: []
+def _iter_gist_events(self, number=300):
+    for event in self.history[:number]:
+        yield GistEvent(event, self)
+class GistEvent(object):
+    type = 'GistHistoryEvent'
+    def __init__(self, history, gist):
+        self.created_at = history.committed_at
+        self.additions = history.additions
+        self.deletions = history.deletions
+        self.actor = history.user
+        if not self.actor.login:
+            self.actor = gist.owner
+        self.repo = ('gist', gist.name)
+github3.gists.Gist.iter_events = _iter_gist_events
+class Content(object):
+    def __init__(self, file):
+        self.decoded = file.content
+def _gist_contents(self, path, ref):
+    # XXX ignore ref for now, can't do much with it
+    for f in self.iter_files():
+        if f.filename == path:
+            return Content(f)
+github3.gists.Gist.contents = _gist_contents
+
+# Monkeypatch github3.session.request to reuse responses, to stay within the
+# rate limits, to retry failed requests and to not wait forever for them
+from github3.session import GitHubSession
+
+import gitspindle.httpcache as httpcache
+import gitspindle.memo as memo
+import gitspindle.ratelimit as ratelimit
+import gitspindle.retry as retry
+import gitspindle.transport as transport
+import functools
+def request(self, method, url, **kwargs):
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = transport.DEFAULT_TIMEOUT
+    send = functools.partial(retry.request, self.orig_request)
+    send = functools.partial(ratelimit.request, send, self.credentials())
+    if method.upper() != 'GET':
+        # Not cached, but forgets what was cached and is refused offline
+        memo.changed(method, url)
+        return httpcache.request(send, method, url, credentials=self.credentials(), **kwargs)
+    extra = [self.headers.get('Authorization'), self.headers.get('Accept'), self.auth]
+    send = functools.partial(httpcache.request, send)
+    return memo.request(send, method, url, extra=extra, credentials=self.credentials(), **kwargs)
+def credentials(self):
+    return [self.headers.get('Authorization'), self.auth]
+def budget(self):
+    """The rate limit budget for this session"""
+    return ratelimit.budget(self.base_url, self.credentials())
+GitHubSession.orig_request = GitHubSession.request
+GitHubSession.request = request
+GitHubSession.credentials = credentials
+GitHubSession.budget = budget
+
+# Monkeypatch github3.structs.GitHubIterator to fetch the remaining pages in
+# parallel when the first page links to the last one
+from github3.models import GitHubCore
+from github3.structs import GitHubIterator
+import gitspindle.pages as pages
+def _iter_responses(self, params, headers):
+    response = self._get(self.last_url, params=params, headers=headers)
+    yield response
+    next_url = response.links.get('next', {}).get('url')
+    last = pages.page_number(response.links.get('last', {}).get('url', ''))
+    if self.count == -1 and next_url and last:
+        # The next link has all parameters already
+        urls = pages.page_urls(next_url, pages.page_number(next_url) or 2, last)
+        get = lambda url: self._get(url, headers=headers)
+        for response in pages.fetch(get, urls, self._session.budget().workers()):
+            yield response
+        return
+    while next_url:
+        response = self._get(next_url, headers=headers)
+        yield response
+        next_url = response.links.get('next', {}).get('url')
+def _iter(self):
+    self.last_url, params, cls = self.url, self.params, self.cls
+    headers = self.headers
+
+    if 0 < self.count <= 100 and self.count != -1:
+        params['per_page'] = self.count
+
+    if 'per_page' not in params and self.count == -1:
+        params['per_page'] = 100
+
+    if self.count == 0:
+        return
+
+    for response in _iter_responses(self, params, headers):
+        self.last_response = response
+        self.last_status = response.status_code
+        self.last_url = response.links.get('next', {}).get('url', '')
+
+        if not self.etag and response.headers.get('ETag'):
+            self.etag = response.headers.get('ETag')
+
+        json = self._get_json(response)
+
+        if json is None:
+            break
+
+        # languages returns a single dict. We want the items.
+        if isinstance(json, dict):
+            if json.get('ETag'):
+                del json['ETag']
+            if json.get('Last-Modified'):
+                del json['Last-Modified']
+            json = json.items()
+
+        for i in json:
+            if i is None:  # Temporary fix for GitHub Enterprise and #304
+                continue
+            yield cls(i, self) if issubclass(cls, GitHubCore) else cls(i)
+            self.count -= 1 if self.count > 0 else 0
+            if self.count == 0:
+                break
+
+        if self.count == 0:
+            break
+GitHubIterator.__iter__ = _iter
+
+# Monkeypatch github3.models.GitHubCore._json to use the fastest json codec
+import gitspindle.jsoncodec as jsoncodec
+def _json(self, response, status_code):
+    ret = None
+    if self._boolean(response, status_code, 404) and response.content:
+        ret = jsoncodec.loads(response.content)
+        headers = response.headers
+        if ((headers.get('Last-Modified') or headers.get('ETag')) and
+                isinstance(ret, dict)):
+            ret['Last-Modified'] = response.headers.get('Last-Modified', '')
+            ret['ETag'] = response.headers.get('ETag', '')
+    return ret
+GitHubCore._json = _json
+
+# Add missing protect_branch / unprotect_branch methods
+import json
+from github3.decorators import requires_auth
+# The preview media type is sent with each request, not set on the session,
+# as other threads may be using the session at the same time
+LOKI_PREVIEW = {'Accept': 'application/vnd.github.loki-preview+json'}
+def branch(self, name):
+    url = self._build_url('branches', name, base_url=self._api)
+    data = self._json(self._get(url, headers=LOKI_PREVIEW), 200)
+    if not data:
+        return
+    branch = github3.repos.branch.Branch(data)
+    branch._session = self._session
+    return branch
+
+def iter_branches(self, number=-1, etag=None, protected=False):
+    url = self._build_url('branches', base_url=self._api)
+    return GitHubIterator(int(number), url, github3.repos.branch.Branch, self, etag=etag, headers=dict(LOKI_PREVIEW), params={'protected': int(protected)})
+
+@requires_auth
+def protect(self, contexts=[], enforcement_level=None):
+    data = {'enabled': True}
+    if contexts or enforcement_level:
+        data['required_status_checks'] = {'contexts': contexts, 'enforcement_level': enforcement_level or 'everyone'}
+    return self._patch(self.links['self'], data=json.dumps({'protection': data}), headers=LOKI_PREVIEW)
+
+@requires_auth
+def unprotect(self):
+    return self._patch(self.links['self'], data=json.dumps({'protection': {'enabled': False}}), headers=LOKI_PREVIEW)
+
+github3.repos.repo.Repository.branch = branch
+github3.repos.repo.Repository.iter_branches = iter_branches
+github3.repos.branch.Branch.protect = protect
+github3.repos.branch.Branch.unprotect = unprotect
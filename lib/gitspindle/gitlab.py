@@ -1,16 +1,17 @@
 from gitspindle import *
 from gitspindle.ansi import *
 import gitspindle.glapi as glapi
+import gitspindle.memo as memo
+import gitspindle.offline as offline
+import gitspindle.retry as retry
 import base64
 import datetime
 import getpass
 import glob
 import json
 import os
-import requests
 import sys
 import time
-import webbrowser
 
 
 class GitLab(GitSpindle):
@@ -18,7 +19,6 @@ class GitLab(GitSpindle):
     what = 'GitLab'
     spindle = 'gitlab'
     hosts = ['gitlab.com', 'www.gitlab.com']
-    api = glapi
     access_levels = {
         'guest':     10,
         'reporter':  20,
@@ -80,34 +80,45 @@ class GitLab(GitSpindle):
         if not token:
             err("No token specified")
 
-        if not self.gl:
-            self.gl = glapi.Gitlab(host, email=user, private_token=token)
-            wrong_password = False
-            try:
-                self.gl.auth()
-            except glapi.GitlabAuthenticationError:
-                if sys.exc_info()[1].response_code != 401:
-                    raise
-                wrong_password = True
+        if self.gl:
+            # We just logged in with a password
+            self.identity_secret = token
+            self.fetch_identity()
+            return
 
-                # Token obsolete or token is a password
-                self.config('token', None)
+        self.gl = glapi.Gitlab(host, email=user, private_token=token)
+        if self.use_cached_identity(token):
+            return
+        wrong_password = False
+        try:
+            self.fetch_identity()
+        except glapi.GitlabAuthenticationError:
+            if sys.exc_info()[1].response_code != 401:
+                raise
+            wrong_password = True
 
-            if wrong_password:
-                # Try Token as password
-                self.login(token)
-                return
+            # Token obsolete or token is a password
+            self.config('token', None)
+
+        if wrong_password:
+            # Try Token as password
+            self.login(token)
 
-        self.me = self.gl.user
-        self.my_login = self.me.username
-        self.config('user', self.my_login)
+    def get_identity(self):
+        if not getattr(self.gl, 'user', None):
+            self.gl.auth()
+        me = self.gl.user
+        return me, {'login': me.username, 'id': me.id, 'scopes': None}
+
+    def is_auth_error(self, exc):
+        return isinstance(exc, glapi.GitlabAuthenticationError)
 
     def parse_url(self, url):
         return ([self.my_login] + url.path.split('/'))[-2:]
 
     def get_repo(self, remote, user, repo):
         if remote:
-            id = self.git('config', 'remote.%s.gitlab-id' % remote).stdout.strip()
+            id = self.git_config('remote.%s.gitlab-id' % remote)
             if id and id.isdigit():
                 return self.gl.Project(id)
 
@@ -128,6 +139,53 @@ class GitLab(GitSpindle):
             return repo.ssh_url_to_repo
         return repo.http_url_to_repo
 
+    def repo_metadata(self, repo):
+        attributes = dict((attr, getattr(repo, attr, None)) for attr in ('id', 'name', 'path', 'path_with_namespace',
+                          'default_branch', 'public', 'visibility_level', 'web_url', 'ssh_url_to_repo', 'http_url_to_repo'))
+        attributes['namespace'] = {'id': repo.namespace.id, 'path': repo.namespace.path}
+        if getattr(repo, 'forked_from_project', None):
+            attributes['forked_from_project'] = {'id': repo.forked_from_project['id']}
+        return repo.path_with_namespace, attributes
+
+    def lean_repo(self, attributes):
+        return glapi.Project(self.gl, dict(attributes, simple='true'))
+
+    def refetch_repo(self, attributes):
+        try:
+            return self.gl.Project(attributes['id'])
+        except glapi.GitlabGetError:
+            pass
+
+    def index_all_repos(self):
+        return self.gl.Project()
+
+    def index_repo(self, repo):
+        attributes = dict((attr, getattr(repo, attr, None)) for attr in ('name', 'path', 'path_with_namespace', 'description',
+                          'visibility_level', 'web_url'))
+        attributes['namespace'] = {'path': repo.namespace.path}
+        if getattr(repo, 'forked_from_project', None):
+            attributes['forked_from_project'] = {'id': repo.forked_from_project['id']}
+        return repo.path_with_namespace, repo.namespace.path, attributes
+
+    def index_issues(self, repo, since):
+        # Older GitLab versions ignore updated_after and send everything
+        params = since and {'updated_after': since} or {}
+        issues = [('issue', issue, issue.web_url) for issue in repo.Issue(**params)]
+        issues += [('pull', mr, '%s/merge_requests/%d' % (repo.web_url, mr.iid)) for mr in repo.MergeRequest(**params)]
+        return [(kind, issue.iid, issue.state, issue.title, issue.description, issue.updated_at,
+                 {'iid': issue.iid, 'title': issue.title, 'web_url': url})
+                for (kind, issue, url) in issues if not since or issue.updated_at >= since]
+
+    def index_releases(self, repo):
+        return [(tag.name, tag.name, tag.release['description'], '%s/tags/%s' % (repo.web_url, tag.name))
+                for tag in repo.Tag() if getattr(tag, 'release', None)]
+
+    def index_members(self, repo):
+        try:
+            return [(member.username, member.access_level) for member in repo.Member()]
+        except glapi.GitlabListError:
+            pass
+
     def parent_repo(self, repo):
        if getattr(repo, 'forked_from_project', False):
            return self.gl.Project(repo.forked_from_project['id'])
@@ -160,7 +218,12 @@ class GitLab(GitSpindle):
         except glapi.GitlabListError:
             pass
 
+    def budget(self):
+        return self.gl.budget()
+
     def merge_url(self, merge):
+        if getattr(merge, 'web_url', None):
+            return merge.web_url
         repo = self.gl.Project(merge.project_id)
         return '%s/merge_requests/%d' % (repo.web_url, merge.iid)
 
@@ -224,8 +287,9 @@ class GitLab(GitSpindle):
         url = self.clone_url(fork, opts)
         name = opts['<name>'] or fork.namespace.path
         self.gitm('remote', 'add', name, url, redirect=False)
-        self.gitm('config', '--add', 'remote.%s.fetch' % name, '+refs/merge-requests/*/head:refs/remotes/%s/merge-requests/*' % name)
-        self.gitm('config', 'remote.%s.gitlab-id' % name, fork.id)
+        with self.config_transaction() as config:
+            config.add('remote.%s.fetch' % name, '+refs/merge-requests/*/head:refs/remotes/%s/merge-requests/*' % name)
+            config.set('remote.%s.gitlab-id' % name, fork.id)
         self.gitm('fetch', '--tags', name, redirect=False)
 
     @command
@@ -258,12 +322,14 @@ class GitLab(GitSpindle):
                 sys.exit(1)
         # Fetch mr if needed
         merge_ref = 'refs/remotes/%s/merge-requests/%d' % (opts['--parent'] and 'upstream' or 'origin', mr.iid)
-        sha = self.git('rev-parse', '--verify', '--quiet', merge_ref).stdout.strip()
+        sha = self.rev_parse(merge_ref)
         if sha != mr.sha:
             print("Fetching merge request")
             self.gitm('fetch', repo.http_url_to_repo, 'refs/merge-requests/%s/head:%s' % (mr.iid, merge_ref), redirect=False)
-        head_sha = self.gitm('rev-parse', '--verify', '--quiet', 'HEAD').stdout.strip()
-        merge_base = self.git('merge-base', mr.sha, head_sha).stdout.strip()
+        head_sha = self.rev_parse('HEAD')
+        if not head_sha:
+            err("Unable to find the current commit")
+        merge_base = self.merge_base(mr.sha, head_sha)
         if merge_base == mr.sha:
             print("Merge request was already merged into this history")
         elif merge_base == head_sha:
@@ -277,6 +343,7 @@ class GitLab(GitSpindle):
     def browse(self, opts):
         """[--parent] [--no-browser] [<repo>] [<section>]
            Open the GitLab page for a repository in a browser"""
+        import webbrowser
         sections = ['issues', 'merge_requests', 'wiki', 'files', 'commits', 'branches', 'graphs', 'settings']
         if opts['<repo>'] in sections and not opts['<section>']:
             opts['<repo>'], opts['<section>'] = None, opts['<repo>']
@@ -287,7 +354,7 @@ class GitLab(GitSpindle):
         url = repo.web_url
         if opts['<section>']:
             url += '/' + section_map.get(opts['<section>'], opts['<section>'])
-        if opts['--no-browser'] or self.git('config', '--bool', 'gitspindle.no-browser').stdout.strip() == 'true':
+        if opts['--no-browser'] or self.git_config_bool('gitspindle.no-browser'):
             print('Please open the URL %s in your browser' % url)
         else:
             webbrowser.open_new(url)
@@ -296,6 +363,7 @@ class GitLab(GitSpindle):
     def calendar(self, opts):
         """[<user>]
            Show a timeline of a user's activity"""
+        import gitspindle.transport as transport
         user = (opts['<user>'] or [self.my_login])[0]
         user = self.find_user(user)
         months = []
@@ -303,11 +371,11 @@ class GitLab(GitSpindle):
         commits = []
 
         kwargs = {'headers': {'PRIVATE-TOKEN': self.gl.private_token}}
-        data = requests.get(user.web_url).text
+        data = transport.get(user.web_url).get(user.web_url).text
         i = data.find('class="user-calendar"')
         data = data[i:data.find('>', i)].split('"')[-2]
         data = data if data else "/users/" + user.username + "/calendar"
-        data = requests.get(self.host + data, **kwargs).text
+        data = transport.get(self.host).get(self.host + data, **kwargs).text
         data = data[data.find('<script>')+8:data.find('</script>')]
         data = data[data.find('{')+1:data.find('}')].replace('"', '')
         data = dict([(datetime.datetime.strptime(key, '%Y-%m-%d').date(), int(value)) for (key,value) in [item.split(':') for item in (data.split(',') if data else [])]])
@@ -453,7 +521,7 @@ class GitLab(GitSpindle):
            Create a repository on gitlab to push to"""
         root = self.gitm('rev-parse', '--show-toplevel').stdout.strip()
         name = os.path.basename(root)
-        if (opts['--group'] or self.my_login, name) in [(x.namespace.path, x.path) for x in self.gl.Project()]:
+        if '%s/%s' % (opts['--group'] or self.my_login, name) in [x.path_with_namespace for x in self.gl.Project(simple='true')]:
             err("Repository already exists")
         visibility_level = 20 # public
         if opts['--internal']:
@@ -546,12 +614,16 @@ class GitLab(GitSpindle):
                 else:
                     self.set_origin(opts, repo=my_fork)
                 success = True
-            except SystemExit as se:
+            except (offline.OfflineError, retry.CircuitOpenError):
+                # Waiting for the fork won't make the server reachable
+                raise
+            except GitSpindleError:
                 # the fork might not be available instantly,
                 # so wait some time for it to appear on the server
                 i += 1
                 time.sleep(1)
-                if not se.code or i >= 120:
+                memo.clear()
+                if i >= 120:
                     raise
 
     @command
@@ -605,37 +677,56 @@ class GitLab(GitSpindle):
 
     @command
     def issues(self, opts):
-        """[<repo>] [--parent] [<filter>...]
+        """[<repo>] [--parent] [--cached] [--search=<words>] [<filter>...]
            List issues in a repository"""
         if opts['<repo>'] and '=' in opts['<repo>']:
             # Let's assume it's a filter
             opts['<filter>'].insert(0, opts['<repo>'])
             opts['<repo>'] = None
-        if not opts['<repo>'] and not self.in_repo:
-            repos = list(self.gl.Project())
+        if any([not '=' in x for x in opts['<filter>']]):
+            err('<filter> must be an equals sign separated key-value pair')
+        filters = dict([x.split('=', 1) for x in opts['<filter>']])
+        if not 'state' in filters:
+            filters['state'] = 'opened'
+        cache = self.repo_cache()
+
+        if opts['--cached'] or opts['--search']:
+            if set(filters) - set(['state']):
+                err('Only the state filter can be used with the local index')
+            names = None
+            if opts['<repo>'] or self.in_repo:
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repo = self.repository(tmpOpts)
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                names = [repo.path_with_namespace]
+            states = {'opened': ['opened', 'reopened'], 'all': None}.get(filters['state'], [filters['state']])
+            found = self.cached_issues(names, states, search=opts['--search'])
         else:
-            # the parent is already retrieved in the for loop below
-            # without this, you get the grandparent instead if there is one
-            tmpOpts = dict(opts)
-            tmpOpts['--parent'] = False
-            repos = [self.repository(tmpOpts)]
-        for repo in repos:
-            repo = (opts['--parent'] and self.parent_repo(repo)) or repo
-            if any([not '=' in x for x in opts['<filter>']]):
-                err('<filter> must be an equals sign separated key-value pair')
-            filters = dict([x.split('=', 1) for x in opts['<filter>']])
-            if not 'state' in filters:
-                filters['state'] = 'opened'
-            issues = repo.Issue(**filters)
-            mergerequests = repo.MergeRequest(state='opened')
+            if not opts['<repo>'] and not self.in_repo:
+                repos = list(self.gl.Project(simple='true'))
+            else:
+                # the parent is already retrieved in the for loop below
+                # without this, you get the grandparent instead if there is one
+                tmpOpts = dict(opts)
+                tmpOpts['--parent'] = False
+                repos = [self.repository(tmpOpts)]
+
+            def fetch(repo):
+                repo = (opts['--parent'] and self.lookup_parent(cache, repo)) or repo
+                return repo, repo.Issue(**filters), repo.MergeRequest(state='opened')
+
+            found = self.for_each(fetch, repos)
+
+        for repo, issues, mergerequests in found:
             if not issues and not mergerequests:
                 continue
             if issues:
-                print(wrap("Issues for %s/%s" % (repo.namespace.path, repo.path), attr.bright))
+                print(wrap("Issues for %s" % repo.path_with_namespace, attr.bright))
                 for issue in issues:
                     print("[%d] %s %s" % (issue.iid, issue.title, issue.web_url))
             if mergerequests:
-                print(wrap("Merge requests for %s/%s" % (repo.namespace.path, repo.path), attr.bright))
+                print(wrap("Merge requests for %s" % repo.path_with_namespace, attr.bright))
                 for mr in mergerequests:
                     print("[%d] %s %s" % (mr.iid, mr.title, self.merge_url(mr)))
 
@@ -772,7 +863,7 @@ class GitLab(GitSpindle):
 
         # Do we have the dst locally?
         for remote in self.gitm('remote').stdout.strip().split("\n"):
-            url = self.gitm('config', 'remote.%s.url' % remote).stdout.strip()
+            url = self.git_config('remote.%s.url' % remote)
             if url in [parent.ssh_url_to_repo, parent.http_url_to_repo]:
                 if not parent.public and url != parent.ssh_url_to_repo:
                     err("You should configure %s/%s to fetch via ssh, it is a private repo" % (parent.namespace.path, parent.path))
@@ -842,8 +933,8 @@ class GitLab(GitSpindle):
         """[--ssh|--http] [--goblet] [<repo>]
            Mirror a repository, or all your repositories"""
         if opts['<repo>'] and opts['<repo>'] == '*':
-            for repo in self.gl.Project():
-                opts['<repo>'] = '%s/%s' % (repo.namespace.path, name)
+            for repo in self.gl.Project(simple='true'):
+                opts['<repo>'] = repo.path_with_namespace
                 self.mirror(opts)
             return
         repo = self.repository(opts)
@@ -919,9 +1010,12 @@ class GitLab(GitSpindle):
 
     @command
     def repos(self, opts):
-        """[--no-forks]
+        """[--no-forks] [--cached]
            List all your repos"""
-        repos = self.gl.Project()
+        if opts['--cached']:
+            repos = self.cached_repos()
+        else:
+            repos = self.gl.Project()
         if not repos:
             return
         maxlen = max([len(x.name) for x in repos])
@@ -955,9 +1049,10 @@ class GitLab(GitSpindle):
         root = self.repository(opts)
         owner = getattr(root, 'owner', False)
         owner = owner and (owner.name or owner.username) or root.namespace.name or root.namespace.path
-        self.gitm('config', 'goblet.owner', owner)
-        self.gitm('config', 'goblet.cloneurlhttp', repo.http_url_to_repo)
-        self.gitm('config', 'goblet.cloneurlssh', repo.ssh_url_to_repo)
+        with self.config_transaction() as config:
+            config.set('goblet.owner', owner)
+            config.set('goblet.cloneurlhttp', repo.http_url_to_repo)
+            config.set('goblet.cloneurlssh', repo.ssh_url_to_repo)
         if repo.description:
             with open(os.path.join(self.gitm('rev-parse', '--git-dir').stdout.strip(), 'description'), 'w') as fd:
                 fd.write(repo.description)
@@ -975,23 +1070,24 @@ class GitLab(GitSpindle):
                 if my_repo:
                     repo = my_repo
 
-        url = self.clone_url(repo, opts)
-        if self.git('config', 'remote.%s.url' % remote).stdout.strip() != url:
-            print("Pointing %s to %s" % (remote, url))
-            self.gitm('config', 'remote.%s.url' % remote, url)
-            self.gitm('config', 'remote.%s.gitlab-id' % remote, repo.id)
-        self.gitm('config', '--replace-all', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
-        self.gitm('config', '--add', 'remote.%s.fetch' % remote, '+refs/merge-requests/*/head:refs/remotes/%s/merge-requests/*' % remote)
-
-        parent = self.parent_repo(repo)
-        if parent:
-            url = self.clone_url(parent, opts)
-            if self.git('config', 'remote.upstream.url').stdout.strip() != url:
-                print("Pointing upstream to %s" % url)
-                self.gitm('config', 'remote.upstream.url', url)
-                self.gitm('config', 'remote.upstream.gitlab-id', parent.id)
-            self.gitm('config', 'remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
-            self.gitm('config', '--add', 'remote.upstream.fetch', '+refs/merge-requests/*/head:refs/remotes/upstream/merge-requests/*')
+        with self.config_transaction() as config:
+            url = self.clone_url(repo, opts)
+            if self.git_config('remote.%s.url' % remote) != url:
+                print("Pointing %s to %s" % (remote, url))
+                config.set('remote.%s.url' % remote, url)
+                config.set('remote.%s.gitlab-id' % remote, repo.id)
+            config.replace_all('remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
+            config.add('remote.%s.fetch' % remote, '+refs/merge-requests/*/head:refs/remotes/%s/merge-requests/*' % remote)
+
+            parent = self.parent_repo(repo)
+            if parent:
+                url = self.clone_url(parent, opts)
+                if self.git_config('remote.upstream.url') != url:
+                    print("Pointing upstream to %s" % url)
+                    config.set('remote.upstream.url', url)
+                    config.set('remote.upstream.gitlab-id', parent.id)
+                config.set('remote.upstream.fetch', '+refs/heads/*:refs/remotes/upstream/*')
+                config.add('remote.upstream.fetch', '+refs/merge-requests/*/head:refs/remotes/upstream/merge-requests/*')
 
         if self.git('ls-remote', remote).stdout.strip():
             self.gitm('fetch', '--prune', '--tags', remote, redirect=False)
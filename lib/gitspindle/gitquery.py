@@ -0,0 +1,158 @@
+# Read-only queries on git objects and refs without starting a git process
+# for each query.
+#
+# If pygit2 is installed, queries are answered in-process. Otherwise
+# long-running git cat-file --batch-check and --batch processes answer them,
+# one per repository. Anything that changes the repository or needs a
+# terminal still runs git as a normal subprocess.
+
+import collections
+import os
+import re
+import subprocess
+
+header_re = re.compile(r'^([0-9a-f]{40,64}) ([a-z]+) ([0-9]+)$')
+
+class CatFile(object):
+    """Queries answered by persistent git cat-file processes"""
+    name = 'cat-file'
+
+    def __init__(self, stats=None):
+        self.processes = {}
+        self.stats = collections.Counter() if stats is None else stats
+        # Where the stderr of all processes goes
+        self.devnull = None
+
+    def process(self, mode):
+        key = (os.getcwd(), mode)
+        proc = self.processes.get(key)
+        if proc is None or proc.poll() is not None:
+            if self.devnull is None:
+                self.devnull = open(os.devnull, 'wb')
+            proc = subprocess.Popen(['git', 'cat-file', '--' + mode], cwd=key[0],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull)
+            self.processes[key] = proc
+            self.stats['git processes'] += 1
+        return proc
+
+    def query(self, mode, name):
+        """Returns sha, type and (for --batch) contents of an object, or None
+           if it does not exist"""
+        if not name or '\n' in name:
+            return None
+        proc = self.process(mode)
+        try:
+            proc.stdin.write((name + '\n').encode('utf-8'))
+            proc.stdin.flush()
+            header = proc.stdout.readline().decode('utf-8').rstrip('\n')
+        except (IOError, OSError):
+            header = ''
+        match = header_re.match(header)
+        if not match:
+            if not header:
+                # Not a repository, or git died. Try again next time.
+                self.close(proc)
+            return None
+        sha, type, size = match.groups()
+        if mode != 'batch':
+            return sha, type, None
+        data = proc.stdout.read(int(size))
+        proc.stdout.read(1)
+        return sha, type, data
+
+    def resolve(self, name):
+        result = self.query('batch-check', name)
+        return result and result[0]
+
+    def object_type(self, name):
+        result = self.query('batch-check', name)
+        return result and result[1]
+
+    def contents(self, name):
+        result = self.query('batch', name)
+        return result and result[2]
+
+    def close(self, proc):
+        for key in [key for key in self.processes if self.processes[key] is proc]:
+            del self.processes[key]
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        proc.wait()
+        proc.stdout.close()
+
+    def reset(self):
+        for proc in list(self.processes.values()):
+            self.close(proc)
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
+
+class Pygit2(object):
+    """Queries answered in-process by libgit2"""
+    name = 'pygit2'
+
+    def __init__(self, stats=None):
+        import pygit2
+        self.pygit2 = pygit2
+        self.repositories = {}
+
+    def repository(self):
+        cwd = os.getcwd()
+        if cwd not in self.repositories:
+            path = self.pygit2.discover_repository(cwd)
+            self.repositories[cwd] = path and self.pygit2.Repository(path)
+        return self.repositories[cwd]
+
+    def lookup(self, name):
+        repo = self.repository()
+        if not repo or not name:
+            return None
+        try:
+            return repo.revparse_single(name)
+        except (KeyError, ValueError, self.pygit2.GitError):
+            return None
+
+    def resolve(self, name):
+        obj = self.lookup(name)
+        return None if obj is None else str(obj.id)
+
+    def object_type(self, name):
+        obj = self.lookup(name)
+        return None if obj is None else type(obj).__name__.lower()
+
+    def contents(self, name):
+        obj = self.lookup(name)
+        return None if obj is None else obj.read_raw()
+
+    def merge_base(self, rev1, rev2):
+        obj1, obj2 = self.lookup(rev1), self.lookup(rev2)
+        if obj1 is None or obj2 is None:
+            return None
+        try:
+            sha = self.repository().merge_base(obj1.id, obj2.id)
+        except (ValueError, self.pygit2.GitError):
+            return None
+        return sha and str(sha)
+
+    def reset(self):
+        self.repositories.clear()
+
+backends = {
+    'pygit2': Pygit2,
+    'cat-file': CatFile,
+}
+
+def backend(name=None, stats=None):
+    """The backend with the given name if it can be used, or else the best
+       one available. Started git processes are counted in stats"""
+    if name:
+        try:
+            return backends[name](stats)
+        except ImportError:
+            pass
+    try:
+        return Pygit2(stats)
+    except ImportError:
+        return CatFile(stats)
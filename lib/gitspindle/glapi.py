@@ -17,8 +17,10 @@
 
 from __future__ import print_function, division, absolute_import
 
+import gitspindle.jsoncodec as jsoncodec
+import gitspindle.pages as pages
+import gitspindle.transport as transport
 import json
-import requests
 import sys
 
 class six:
@@ -123,7 +125,7 @@ def _raiseErrorFromResponse(response, error):
     """
 
     try:
-        message = response.json()['message']
+        message = jsoncodec.loads(response.content)['message']
     except (KeyError, ValueError):
         message = response.content
 
@@ -150,7 +152,8 @@ class Gitlab(object):
         password: the user password (associated with email)
         ssl_verify: (Passed to requests-library)
         timeout: (Passed to requests-library). Timeout to use for requests to
-          gitlab server. Float or tuple(Float,Float).
+          gitlab server. Float or tuple(Float,Float). Defaults to
+          transport.DEFAULT_TIMEOUT.
         """
         self._url = '%s/api/v3' % url
         self.timeout = timeout
@@ -179,7 +182,7 @@ class Gitlab(object):
         r = self.rawPost('/session',
                          {'email': self.email, 'password': self.password})
         if r.status_code == 201:
-            self.user = CurrentUser(self, r.json())
+            self.user = CurrentUser(self, jsoncodec.loads(r.content))
         else:
             _raiseErrorFromResponse(r, GitlabAuthenticationError)
 
@@ -188,6 +191,10 @@ class Gitlab(object):
     def token_auth(self):
         self.user = CurrentUser(self)
 
+    @property
+    def transport(self):
+        return transport.get(self._url)
+
     def setUrl(self, url):
         """Updates the gitlab URL"""
         self._url = '%s/api/v3' % url
@@ -207,7 +214,13 @@ class Gitlab(object):
     def setToken(self, token):
         """Sets the private token for authentication"""
         self.private_token = token if token else None
-        self.headers = {"PRIVATE-TOKEN": token} if token else None
+
+    @property
+    def headers(self):
+        """Headers for a request. A new dict every time, so requests in other
+        threads can't change them"""
+        if self.private_token:
+            return {"PRIVATE-TOKEN": self.private_token}
 
     def setCredentials(self, email, password):
         """Sets the email/login and password for authentication"""
@@ -221,22 +234,22 @@ class Gitlab(object):
                    ["%s=%s" % (k, v) for k, v in kwargs.items()]))
 
         try:
-            return requests.get(url,
+            return self.transport.get(url,
                                 headers=self.headers,
                                 verify=self.ssl_verify,
                                 timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
     def rawPost(self, path, data=None):
         url = '%s%s' % (self._url, path)
         try:
-            return requests.post(url, data,
+            return self.transport.post(url, data,
                                  headers=self.headers,
                                  verify=self.ssl_verify,
                                  timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
@@ -244,11 +257,11 @@ class Gitlab(object):
         url = '%s%s' % (self._url, path)
 
         try:
-            return requests.put(url,
+            return self.transport.put(url,
                                 headers=self.headers,
                                 verify=self.ssl_verify,
                                 timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
@@ -256,11 +269,11 @@ class Gitlab(object):
         url = '%s%s' % (self._url, path)
 
         try:
-            return requests.delete(url,
+            return self.transport.delete(url,
                                    headers=self.headers,
                                    verify=self.ssl_verify,
                                    timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
@@ -301,25 +314,45 @@ class Gitlab(object):
                 del cls_kwargs[key]
 
         kwargs['per_page'] = 100
-        while True:
-            try:
-                r = requests.get(url, params=kwargs, headers=self.headers,
-                                 verify=self.ssl_verify,
-                                 timeout=self.timeout)
-            except:
-                raise GitlabConnectionError(
-                    "Can't connect to GitLab server (%s)" % self._url)
-
-            if r.status_code == 200:
-                for item in r.json():
-                    if item is not None:
-                        yield cls(self, item, **cls_kwargs)
-            else:
-                _raiseErrorFromResponse(r, GitlabListError)
-            if 'next' in r.links:
-                url = r.links['next']['url']
-            else:
-                break
+        for r in self._pages(url, kwargs):
+            for item in jsoncodec.iter_items(r.content):
+                if item is not None:
+                    yield cls(self, item, **cls_kwargs)
+
+    def _page(self, url, params=None):
+        try:
+            r = self.transport.get(url, params=params, headers=self.headers,
+                             verify=self.ssl_verify,
+                             timeout=self.timeout)
+        except IOError:
+            raise GitlabConnectionError(
+                "Can't connect to GitLab server (%s)" % self._url)
+
+        if r.status_code != 200:
+            _raiseErrorFromResponse(r, GitlabListError)
+        return r
+
+    def budget(self):
+        """The rate limit budget of this connection"""
+        return self.transport.budget(headers=self.headers)
+
+    def _pages(self, url, params):
+        """Yields the responses for all pages of a listing. If the number of
+        pages is known after the first one, the rest are fetched in
+        parallel"""
+        r = self._page(url, params)
+        yield r
+        total = r.headers.get('X-Total-Pages', '')
+        if total.isdigit() and 'next' in r.links:
+            # The next link has all parameters already
+            urls = pages.page_urls(r.links['next']['url'], 2, int(total))
+            workers = self.budget().workers()
+            for r in pages.fetch(self._page, urls, workers):
+                yield r
+            return
+        while 'next' in r.links:
+            r = self._page(r.links['next']['url'], params)
+            yield r
 
 
     def get(self, obj_class, id=None, **kwargs):
@@ -341,14 +374,14 @@ class Gitlab(object):
             del params[attribute]
 
         try:
-            r = requests.get(url, params=params, headers=self.headers,
+            r = self.transport.get(url, params=params, headers=self.headers,
                              verify=self.ssl_verify, timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
         if r.status_code == 200:
-            return r.json()
+            return jsoncodec.loads(r.content)
         else:
             _raiseErrorFromResponse(r, GitlabGetError)
 
@@ -371,12 +404,12 @@ class Gitlab(object):
             del params[attribute]
 
         try:
-            r = requests.delete(url,
+            r = self.transport.delete(url,
                                 params=params,
                                 headers=self.headers,
                                 verify=self.ssl_verify,
                                 timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
@@ -401,16 +434,16 @@ class Gitlab(object):
                 obj.__dict__[k] = 1 if v else 0
 
         try:
-            r = requests.post(url, obj.__dict__,
+            r = self.transport.post(url, obj.__dict__,
                               headers=self.headers,
                               verify=self.ssl_verify,
                               timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
         if r.status_code == 201:
-            return r.json()
+            return jsoncodec.loads(r.content)
         else:
             _raiseErrorFromResponse(r, GitlabCreateError)
 
@@ -434,16 +467,16 @@ class Gitlab(object):
                 d[k] = str(v.encode(self.gitlab_encoding, "replace"))
 
         try:
-            r = requests.put(url, d,
+            r = self.transport.put(url, d,
                              headers=self.headers,
                              verify=self.ssl_verify,
                              timeout=self.timeout)
-        except:
+        except IOError:
             raise GitlabConnectionError(
                 "Can't connect to GitLab server (%s)" % self._url)
 
         if r.status_code == 200:
-            return r.json()
+            return jsoncodec.loads(r.content)
         else:
             _raiseErrorFromResponse(r, GitlabUpdateError)
 
@@ -487,7 +520,7 @@ class Gitlab(object):
             _raiseErrorFromResponse(r, GitlabListError)
 
         l = []
-        for o in r.json():
+        for o in jsoncodec.iter_items(r.content):
             l.append(Project(self, o))
 
         return l
@@ -636,6 +669,18 @@ class GitlabObject(object):
             else:
                 self.__dict__[k] = self._getObject(k, v)
 
+    def __getattr__(self, name):
+        # Objects listed with simple=true only have a few attributes, fetch
+        # the full object when any other attribute is used.
+        if name.startswith('__') or not self.__dict__.get('simple') or \
+                self.__dict__.get('id') is None:
+            raise AttributeError(name)
+        del self.__dict__['simple']
+        kwargs = dict((k, self.__dict__[k]) for k in self.requiredUrlAttrs
+                      if k in self.__dict__)
+        self._setFromDict(self.gitlab.get(self.__class__, self.id, **kwargs))
+        return getattr(self, name)
+
     def _create(self):
         if not self.canCreate:
             raise NotImplementedError
@@ -884,7 +929,7 @@ class ProjectCommit(GitlabObject):
                % {'project_id': self.project_id, 'commit_id': self.id})
         r = self.gitlab.rawGet(url)
         if r.status_code == 200:
-            return r.json()
+            return jsoncodec.loads(r.content)
         else:
             _raiseErrorFromResponse(r, GitlabGetError)
 
@@ -1072,6 +1117,7 @@ class ProjectSnippet(GitlabObject):
 
 
 class UserProject(GitlabObject):
+    spindle = 'gitlab'
     _url = '/projects/user/%(user_id)s'
     _constructorTypes = {'owner': 'User', 'namespace': 'Group'}
     canUpdate = False
@@ -1087,6 +1133,7 @@ class UserProject(GitlabObject):
 
 
 class Project(GitlabObject):
+    spindle = 'gitlab'
     _url = '/projects'
     _constructorTypes = {'owner': 'User', 'namespace': 'Group'}
     canUpdate = False
@@ -1173,7 +1220,7 @@ class Project(GitlabObject):
         url += '?path=%s&ref_name=%s' % (path, ref_name)
         r = self.gitlab.rawGet(url)
         if r.status_code == 200:
-            return r.json()
+            return jsoncodec.loads(r.content)
         else:
             _raiseErrorFromResponse(r, GitlabGetError)
 
@@ -1225,7 +1272,7 @@ class Project(GitlabObject):
         r = self.gitlab.rawPost(url)
         if r.status_code != 201:
             _raiseErrorFromResponse(r, GitlabForkError)
-        return Project(self.gitlab, r.json())
+        return Project(self.gitlab, jsoncodec.loads(r.content))
 
 
 class TeamMember(GitlabObject):
@@ -0,0 +1,231 @@
+# On-disk cache for API responses
+#
+# Responses to GET requests that carry an ETag or Last-Modified header are
+# stored with those validators. The next identical request is sent with
+# If-None-Match/If-Modified-Since, and a 304 Not Modified answer is turned
+# back into the stored response. Entries are keyed on everything that can
+# change the answer, including (a hash of) the credentials, and are written
+# atomically so concurrent processes can share the cache.
+#
+# Responses to requests with credentials can be private, so they are only
+# stored when the user asks for that, see configure(). Only the user can
+# read the cache.
+#
+# Responses without validators are stored too, so they can be used when the
+# host can't be reached, see gitspindle.offline. The modification time of an
+# entry is when the host last confirmed it.
+#
+# Once per command, when something is stored, entries that were not
+# confirmed for MAX_AGE seconds are removed, and then the ones confirmed
+# longest ago until the cache is no bigger than MAX_SIZE bytes.
+
+import gitspindle
+from gitspindle.gitconfig import replace
+import gitspindle.offline as offline
+import gitspindle.retry as retry
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# How often a request is retried when a cached answer can be used instead
+FALLBACK_RETRIES = 1
+# Limits on the age of entries and the size of the cache
+MAX_AGE = 30 * 86400
+MAX_SIZE = 100 * 1024 * 1024
+
+prune_lock = threading.Lock()
+pruned = False
+# Whether responses to requests with credentials are stored
+authenticated = False
+
+def configure(store_authenticated=False):
+    """Set whether responses to requests with credentials are stored"""
+    global authenticated
+    authenticated = store_authenticated
+
+# Headers that describe the stored body or the connection, rather than the
+# resource, so they are not stored
+skip_headers = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+def cache_key(method, url, kwargs, extra):
+    key = [method, url, kwargs.get('params'), kwargs.get('headers'), kwargs.get('auth'), extra]
+    key = json.dumps(key, sort_keys=True, default=repr)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def cache_file(key):
+    return gitspindle.cache_path('http', key[:2], key[2:] + '.json')
+
+def load(key):
+    try:
+        with open(cache_file(key)) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+def store(key, response):
+    prune_once()
+    headers = dict((key_.lower(), value) for (key_, value) in response.headers.items() if key_.lower() not in skip_headers)
+    entry = {
+        'url': response.url,
+        'status': response.status_code,
+        'reason': response.reason,
+        'headers': headers,
+        'encoding': response.encoding,
+        'body': base64.b64encode(response.content).decode('ascii'),
+    }
+    file = cache_file(key)
+    try:
+        make_dirs(os.path.dirname(file))
+        # Only readable by the user
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file))
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(entry, fd)
+        replace(tmp, file)
+    except (IOError, OSError):
+        # A cache that can't be written is not a reason to fail
+        pass
+
+def make_dirs(path):
+    """Create a directory and its parents, only accessible by the user"""
+    if os.path.isdir(path):
+        return
+    make_dirs(os.path.dirname(path))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        # Another thread or process may have created it
+        if not os.path.isdir(path):
+            raise
+
+def prune_once():
+    global pruned
+    with prune_lock:
+        if pruned:
+            return
+        pruned = True
+    prune()
+
+def prune(max_age=MAX_AGE, max_size=MAX_SIZE):
+    """Remove the entries confirmed longest ago, until none is older than
+       max_age and all are no bigger than max_size"""
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(gitspindle.cache_path('http')):
+        for name in filenames:
+            file = os.path.join(dirpath, name)
+            try:
+                info = os.stat(file)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, file))
+    entries.sort()
+    now = time.time()
+    size = sum(entry[1] for entry in entries)
+    for (mtime, size_, file) in entries:
+        if now - mtime < max_age and size <= max_size:
+            break
+        try:
+            os.unlink(file)
+        except OSError:
+            pass
+        size -= size_
+
+def response_from(entry, fresh=None):
+    """Recreate a requests response from a cache entry. Headers from a fresh
+       304 response, such as rate limit information, take precedence"""
+    import requests
+    import requests.structures
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.reason = entry['reason']
+    response.url = entry['url']
+    response.encoding = entry['encoding']
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response._content = base64.b64decode(entry['body'])
+    if fresh is not None:
+        response.headers.update((key, value) for (key, value) in fresh.headers.items() if key.lower() not in skip_headers)
+        response.request = fresh.request
+        response.elapsed = fresh.elapsed
+        response.cookies = fresh.cookies
+    return response
+
+def cacheable(method, kwargs, credentials):
+    if method.upper() != 'GET' or kwargs.get('stream'):
+        return False
+    if any(credentials or ()) and not authenticated:
+        return False
+    # The caller does its own conditional requests
+    headers = kwargs.get('headers') or {}
+    return not any(key.lower() in ('if-none-match', 'if-modified-since') for key in headers)
+
+def request(send, method, url, extra=None, credentials=None, **kwargs):
+    """Do a request with send(method, url, **kwargs), using the cache for GET
+       requests. Extra is anything else that can change the answer, such as
+       session headers, and credentials whatever authenticates the request.
+       When offline, or when the host can't be reached, GET requests are
+       answered from the cache and others fail"""
+    import requests
+    if not cacheable(method, kwargs, credentials):
+        if offline.is_offline(url):
+            raise offline.error(method, url)
+        try:
+            return send(method, url, **kwargs)
+        except (requests.exceptions.SSLError, retry.CircuitOpenError):
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            offline.went_offline(url)
+            raise offline.error(method, url)
+
+    key = cache_key(method, url, kwargs, [extra, credentials])
+    entry = load(key)
+    if offline.is_offline(url):
+        return cached_response(key, entry, method, url)
+    if entry:
+        headers = dict(kwargs.get('headers') or {})
+        if 'etag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        kwargs['headers'] = headers
+        kwargs['retries'] = FALLBACK_RETRIES
+
+    try:
+        response = send(method, url, **kwargs)
+    except requests.exceptions.SSLError:
+        # Not something that going offline fixes
+        raise
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, retry.CircuitOpenError):
+        offline.went_offline(url)
+        return cached_response(key, entry, method, url)
+    if response.status_code in retry.RETRY_STATUS and entry:
+        # Down for maintenance, or worse
+        offline.went_offline(url)
+        return cached_response(key, entry, method, url)
+    if response.status_code == 304 and entry:
+        gitspindle.stats.add('http cache hits')
+        touch(key)
+        response = response_from(entry, response)
+    elif response.status_code == 200 and 'no-store' not in response.headers.get('Cache-Control', ''):
+        store(key, response)
+    return response
+
+def cached_response(key, entry, method, url):
+    """The stored response for a request that is not sent"""
+    if not entry:
+        raise offline.error(method, url)
+    gitspindle.stats.add('offline responses')
+    try:
+        offline.used(os.path.getmtime(cache_file(key)))
+    except OSError:
+        pass
+    return response_from(entry)
+
+def touch(key):
+    """Remember that the host confirmed an entry"""
+    try:
+        os.utime(cache_file(key), None)
+    except OSError:
+        pass
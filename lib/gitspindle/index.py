@@ -0,0 +1,213 @@
+# A local index of repositories, issues and pull requests
+#
+# The sync command stores your repositories, their issues, pull or merge
+# requests, releases and members in an SQLite database, one per account. With
+# --cached, listing commands read from it instead of asking the API, which
+# takes milliseconds instead of minutes for many repositories. Titles and
+# bodies of issues and pull requests are indexed for full text search, using
+# SQLite's fts5 module if it's available. Rows of the full text index have
+# the rowid of the issue they belong to.
+#
+# Listing commands print objects from the API clients. The index stores the
+# attributes they need, and returns them as Records, which have the same
+# attributes.
+
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repositories (
+    name TEXT PRIMARY KEY,
+    owner TEXT,
+    data TEXT,
+    synced REAL
+);
+CREATE TABLE IF NOT EXISTS issues (
+    repository TEXT,
+    kind TEXT,
+    number INTEGER,
+    state TEXT,
+    title TEXT,
+    body TEXT,
+    updated TEXT,
+    data TEXT,
+    PRIMARY KEY (repository, kind, number)
+);
+CREATE TABLE IF NOT EXISTS releases (
+    repository TEXT,
+    tag TEXT,
+    name TEXT,
+    body TEXT,
+    url TEXT,
+    PRIMARY KEY (repository, tag)
+);
+CREATE TABLE IF NOT EXISTS members (
+    repository TEXT,
+    login TEXT,
+    access TEXT,
+    PRIMARY KEY (repository, login)
+);
+CREATE TABLE IF NOT EXISTS synced (
+    repository TEXT,
+    what TEXT,
+    since TEXT,
+    PRIMARY KEY (repository, what)
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS issues_text USING fts5(
+    title,
+    body
+);
+"""
+
+class Record(dict):
+    """Attributes of an object as stored in the index, readable as
+       attributes"""
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, dict) and not isinstance(value, Record):
+            value = self[name] = Record(value)
+        return value
+
+class Index(object):
+    """The index for a single account"""
+    def __init__(self, path):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # No fts5, searches fall back to LIKE
+            self.fts = False
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def update_repositories(self, repos, complete=True):
+        """Store repos, a list of (name, owner, attributes) tuples. If they
+           are all repositories of the account, everything stored for other
+           repositories is removed"""
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO repositories (name, owner, data, synced) VALUES (?, ?, ?, ?)",
+                                [(name, owner, json.dumps(attributes), now) for (name, owner, attributes) in repos])
+            if complete:
+                names = set(repo[0] for repo in repos)
+                for (name,) in self.db.execute("SELECT name FROM repositories").fetchall():
+                    if name not in names:
+                        self.remove_repository(name)
+
+    def remove_repository(self, name):
+        if self.fts:
+            self.db.execute("DELETE FROM issues_text WHERE rowid IN (SELECT rowid FROM issues WHERE repository = ?)", (name,))
+        for table in ('repositories', 'issues', 'releases', 'members', 'synced'):
+            column = table == 'repositories' and 'name' or 'repository'
+            self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (name,))
+
+    def repositories(self, owner=None, with_names=False):
+        """Repositories as Records, sorted by name, or as (name, Record)
+           tuples if with_names is given"""
+        query, args = "SELECT name, data FROM repositories", ()
+        if owner:
+            query, args = query + " WHERE lower(owner) = lower(?)", (owner,)
+        repos = [(name, Record(json.loads(data))) for (name, data) in self.db.execute(query + " ORDER BY lower(name)", args)]
+        if with_names:
+            return repos
+        return [repo for (name, repo) in repos]
+
+    def synced(self):
+        """When the repository that was synced longest ago was synced, None
+           if nothing was"""
+        return self.db.execute("SELECT MIN(synced) FROM repositories").fetchone()[0]
+
+    def since(self, repository, what):
+        """Up to when what was synced for a repository, as given to
+           set_since"""
+        row = self.db.execute("SELECT since FROM synced WHERE repository = ? AND what = ?", (repository, what)).fetchone()
+        return row and row[0]
+
+    def update_issues(self, repository, issues, since=None):
+        """Store issues, a list of (kind, number, state, title, body, updated,
+           attributes) tuples. kind is 'issue' or 'pull'. since is remembered
+           for the next sync"""
+        with self.db:
+            if self.fts:
+                # Deleting from the full text index between inserts makes it
+                # flush what it has pending every time, so delete all first
+                find = "SELECT rowid FROM issues WHERE repository = ? AND kind = ? AND number = ?"
+                old = [self.db.execute(find, (repository, issue[0], issue[1])).fetchone() for issue in issues]
+                self.db.executemany("DELETE FROM issues_text WHERE rowid = ?", [rowid for rowid in old if rowid])
+            text = []
+            for (kind, number, state, title, body, updated, attributes) in issues:
+                cursor = self.db.execute("INSERT OR REPLACE INTO issues (repository, kind, number, state, title, body, updated, data) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                         (repository, kind, number, state, title, body or '', updated, json.dumps(attributes)))
+                text.append((cursor.lastrowid, title, body or ''))
+            if self.fts:
+                self.db.executemany("INSERT INTO issues_text (rowid, title, body) VALUES (?, ?, ?)", text)
+            self.set_since(repository, 'issues', since)
+
+    def update_releases(self, repository, releases):
+        """Replace the releases of a repository with releases, a list of (tag,
+           name, body, url) tuples"""
+        with self.db:
+            self.db.execute("DELETE FROM releases WHERE repository = ?", (repository,))
+            self.db.executemany("INSERT OR REPLACE INTO releases (repository, tag, name, body, url) VALUES (?, ?, ?, ?, ?)",
+                                [(repository,) + tuple(release) for release in releases])
+
+    def update_members(self, repository, members):
+        """Replace the members of a repository with members, a list of
+           (login, access) tuples"""
+        with self.db:
+            self.db.execute("DELETE FROM members WHERE repository = ?", (repository,))
+            self.db.executemany("INSERT OR REPLACE INTO members (repository, login, access) VALUES (?, ?, ?)",
+                                [(repository,) + tuple(member) for member in members])
+
+    def set_since(self, repository, what, since):
+        if since is None:
+            self.db.execute("DELETE FROM synced WHERE repository = ? AND what = ?", (repository, what))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO synced (repository, what, since) VALUES (?, ?, ?)", (repository, what, since))
+
+    def issues(self, repositories=None, states=None, closed=None, search=None):
+        """Issues and pull requests as (repository, kind, Record) tuples,
+           sorted by repository and number. Only those in one of states if
+           given, and not in one of closed. If search is given, only those
+           whose title or body contain all its words"""
+        where, args = [], []
+        if repositories is not None:
+            where.append("issues.repository IN (%s)" % ', '.join('?' * len(repositories)))
+            args += repositories
+        for (states, op) in ((states, 'IN'), (closed, 'NOT IN')):
+            if states:
+                where.append("lower(issues.state) %s (%s)" % (op, ', '.join('?' * len(states))))
+                args += [state.lower() for state in states]
+        query = "SELECT issues.repository, issues.kind, issues.data FROM issues"
+        if search and self.fts:
+            query += " JOIN issues_text ON issues_text.rowid = issues.rowid"
+            where.append("issues_text MATCH ?")
+            args.append(fts_query(search))
+        elif search:
+            for word in search.split():
+                where.append("(issues.title LIKE ? OR issues.body LIKE ?)")
+                args += ['%' + word + '%'] * 2
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY lower(issues.repository), issues.number"
+        return [(repository, kind, Record(json.loads(data))) for (repository, kind, data) in self.db.execute(query, args)]
+
+def fts_query(search):
+    """Words to search for as an fts5 query that matches all of them, without
+       having to worry about fts5's syntax"""
+    return ' '.join('"%s"' % word.replace('"', '""') for word in search.split())
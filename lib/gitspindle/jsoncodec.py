@@ -0,0 +1,95 @@
+# Decoding API responses
+#
+# Responses are decoded with the fastest JSON library that is installed,
+# falling back to the standard library.
+
+import json
+
+class Json(object):
+    """The json module from the standard library"""
+    name = 'json'
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+class Orjson(object):
+    """orjson, which is several times faster than json"""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+    def dumps(self, obj):
+        return self.orjson.dumps(obj).decode('utf-8')
+
+class Ujson(object):
+    """ujson, which is faster than json"""
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+    def dumps(self, obj):
+        return self.ujson.dumps(obj)
+
+codecs = {
+    'orjson': Orjson,
+    'ujson': Ujson,
+    'json': Json,
+}
+preference = ('orjson', 'ujson', 'json')
+
+def codec(name=None):
+    """The codec with the given name if it is installed, or else the best
+       one available"""
+    if name:
+        try:
+            return codecs[name]()
+        except ImportError:
+            pass
+    for name in preference:
+        try:
+            return codecs[name]()
+        except ImportError:
+            pass
+
+wanted = None
+current = None
+
+def use(name=None):
+    """Use the codec with the given name, or the best one available. It is
+       loaded when it is first needed"""
+    global wanted, current
+    wanted, current = name, None
+
+def get():
+    global current
+    if current is None:
+        current = codec(wanted)
+    return current
+
+def loads(data):
+    return get().loads(data)
+
+def dumps(obj):
+    return get().dumps(obj)
+
+def iter_items(data):
+    """The items of a JSON array"""
+    items = loads(data)
+    if not isinstance(items, list):
+        raise ValueError("Expected a JSON array")
+    return items
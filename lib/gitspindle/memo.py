@@ -0,0 +1,97 @@
+# Asking for the same thing only once per command
+#
+# Commands often fetch the same resource more than once, for example a
+# repository to look up different things about it. Successful GET
+# responses are remembered until the command is done, and identical
+# requests that are made at the same time, by parallel page fetches, wait
+# for the first one instead of going to the server as well.
+#
+# Anything that changes something on a host forgets all responses from that
+# host: it's impossible to tell which listings and objects a change affects.
+#
+# Before the first change, a check can be done, such as whether credentials
+# that were not used yet are accepted.
+
+from gitspindle import stats
+from gitspindle.httpcache import cache_key
+import threading
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+lock = threading.Lock()
+responses = {}
+in_flight = {}
+generations = {}
+check_lock = threading.Lock()
+check = None
+
+def host(url):
+    return url.partition('://')[2].split('/', 1)[0]
+
+def clear():
+    """Forget everything, for when the next request must see changes that
+       were made elsewhere"""
+    with lock:
+        responses.clear()
+        for key in generations:
+            generations[key] += 1
+
+def check_before_changes(func):
+    """Call func before anything is changed. It is called again for the next
+       change if it raises an exception"""
+    global check
+    with check_lock:
+        check = func
+
+def changed(method, url):
+    """Forget all responses from the host of url if method changes something"""
+    global check
+    if method.upper() in SAFE_METHODS:
+        return
+    # GraphQL queries are sent with POST, but only read
+    if url.endswith('/graphql'):
+        return
+    with check_lock:
+        if check is not None:
+            check()
+            check = None
+    host_ = host(url)
+    with lock:
+        for key in [key for key in responses if responses[key][0] == host_]:
+            del responses[key]
+        generations[host_] = generations.get(host_, 0) + 1
+
+def request(send, method, url, extra=None, **kwargs):
+    """Do a request with send(method, url, extra=extra, **kwargs), unless
+       the same request was done before or is being done right now"""
+    if method.upper() != 'GET' or kwargs.get('stream'):
+        changed(method, url)
+        return send(method, url, extra=extra, **kwargs)
+
+    host_ = host(url)
+    key = cache_key(method, url, kwargs, extra)
+    while True:
+        with lock:
+            if key in responses:
+                stats.add('memoized requests')
+                return responses[key][1]
+            event = in_flight.get(key)
+            if event is None:
+                event = in_flight[key] = threading.Event()
+                generation = generations.get(host_, 0)
+                break
+        # Someone else is asking the same. If that fails, we try ourselves
+        stats.add('coalesced requests')
+        event.wait()
+
+    response = None
+    try:
+        response = send(method, url, extra=extra, **kwargs)
+        return response
+    finally:
+        with lock:
+            # Don't remember responses that may predate a change
+            if response is not None and 200 <= response.status_code < 300 and generation == generations.get(host_, 0):
+                responses[key] = (host_, response)
+            del in_flight[key]
+        event.set()
@@ -0,0 +1,80 @@
+# Working without the service
+#
+# With --offline, no requests are sent at all. GET requests are answered from
+# the response cache (see gitspindle.httpcache), no matter how old the answer
+# is, and anything else fails immediately. Listing commands use the local
+# index (see gitspindle.index) instead of the API.
+#
+# When a host can't be reached, git-spindle goes offline for that host by
+# itself: the failed request and all further ones are answered the same way,
+# instead of each of them waiting for timeouts and retries.
+#
+# Commands that showed cached data while offline say how old it is.
+
+from gitspindle import GitSpindleError
+import threading
+import time
+
+class OfflineError(GitSpindleError):
+    pass
+
+lock = threading.Lock()
+enabled = False
+unreachable = []
+oldest = None
+
+def host(url):
+    return url.partition('://')[2].split('/', 1)[0]
+
+def reset(offline=False):
+    """Start a new command, offline or not"""
+    global enabled, oldest
+    with lock:
+        enabled = offline
+        del unreachable[:]
+        oldest = None
+
+def is_offline(url=None):
+    """Whether requests to the host of url, or any host, are not sent"""
+    with lock:
+        if url is None:
+            return enabled or bool(unreachable)
+        return enabled or host(url) in unreachable
+
+def went_offline(url):
+    """Remember that the host of url can't be reached"""
+    with lock:
+        if host(url) not in unreachable:
+            unreachable.append(host(url))
+
+def used(timestamp):
+    """Remember that data fetched at timestamp was used"""
+    global oldest
+    with lock:
+        if timestamp is not None and (oldest is None or timestamp < oldest):
+            oldest = timestamp
+
+def error(method, url):
+    """The error for a request that can't be done offline"""
+    if not enabled:
+        return OfflineError("%s could not be reached" % host(url))
+    if method.upper() == 'GET':
+        return OfflineError("%s is not available offline" % url)
+    return OfflineError("Nothing can be changed on %s while offline" % host(url))
+
+def age(seconds):
+    for (unit, size) in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return '%d %s%s' % (count, unit, 's' * (count != 1))
+    return 'less than a minute'
+
+def staleness():
+    """A note on the age of the cached data that was shown, or None"""
+    with lock:
+        if oldest is None or not (enabled or unreachable):
+            return None
+        when = age(max(0, time.time() - oldest))
+        if enabled:
+            return "Working offline, using data from up to %s ago" % when
+        return "Could not reach %s, using data from up to %s ago" % (', '.join(unreachable), when)
@@ -0,0 +1,88 @@
+# Fetching the pages of long listings in parallel
+#
+# The APIs return listings a page at a time, each page linking to the next.
+# When the first page also says how many pages there are, the others can be
+# fetched at the same time by a few threads. Pages are still returned in
+# order, and only a few pages are fetched ahead of the one being processed,
+# so stopping early does not fetch the whole listing.
+
+import sys
+import threading
+
+try:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+except ImportError:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+
+# How many pages to fetch ahead per thread
+LOOKAHEAD = 2
+
+def page_url(url, page, param='page'):
+    """The url with its page parameter set to page"""
+    parts = urlsplit(url)
+    query = [(key, value) for (key, value) in parse_qsl(parts.query, keep_blank_values=True) if key != param]
+    query.append((param, str(page)))
+    return urlunsplit(parts[:3] + (urlencode(query),) + parts[4:])
+
+def page_number(url, param='page'):
+    """The page parameter of url as a number, or None"""
+    for key, value in parse_qsl(urlsplit(url).query):
+        if key == param and value.isdigit():
+            return int(value)
+
+def page_urls(url, first, last, param='page'):
+    """Urls for pages first up to and including last, based on url"""
+    return [page_url(url, page, param) for page in range(first, last + 1)]
+
+def fetch(get, items, workers):
+    """Like map(get, items), but calls get in up to workers threads. Results
+       are yielded in order. Exceptions are raised when their result is
+       reached"""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield get(item)
+        return
+
+    results = {}
+    state = {'next': 0, 'done': 0, 'stop': False}
+    cond = threading.Condition()
+    window = workers * LOOKAHEAD
+
+    def worker():
+        while True:
+            with cond:
+                while not state['stop'] and state['next'] < len(items) and state['next'] >= state['done'] + window:
+                    cond.wait()
+                if state['stop'] or state['next'] >= len(items):
+                    return
+                idx = state['next']
+                state['next'] += 1
+            try:
+                result = (True, get(items[idx]))
+            except Exception:
+                result = (False, sys.exc_info()[1])
+            with cond:
+                results[idx] = result
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for idx in range(len(items)):
+            with cond:
+                while idx not in results:
+                    cond.wait()
+                ok, result = results.pop(idx)
+                state['done'] = idx + 1
+                cond.notify_all()
+            if not ok:
+                raise result
+            yield result
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
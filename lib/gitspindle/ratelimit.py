@@ -0,0 +1,182 @@
+# Pacing API requests to stay within rate limits
+#
+# Every response tells us how much of the rate limit budget is left for the
+# token that made it: GitHub sends X-RateLimit-*, GitLab RateLimit-* and
+# anyone may send Retry-After. GitHub has separate limits for its REST and
+# GraphQL APIs and for searches, and X-RateLimit-Resource says which one a
+# response counts against. We keep track of that per host, token and limit and
+#
+# - spread the last part of the budget over the time left until it resets,
+#   instead of running into the limit and then failing;
+# - wait until the budget resets when it is exhausted;
+# - back off and retry when a request is throttled anyway, which happens with
+#   GitHub's secondary rate limits that are not announced in advance. Only
+#   requests that can safely be repeated are retried, and only for a while;
+# - halve the number of requests allowed in parallel after throttling, and
+#   slowly increase it again after successful requests.
+
+from gitspindle import stats
+from gitspindle.ansi import wrap, fgcolor, attr
+from gitspindle.retry import IDEMPOTENT
+import sys
+import threading
+import time
+
+# Start pacing requests when less than this fraction of the budget is left
+PACE_FRACTION = 0.1
+# How long to wait after being throttled without being told how long
+DEFAULT_BACKOFF = 60
+MAX_BACKOFF = 900
+# How often to retry a throttled request, and for how long in total
+MAX_RETRIES = 5
+MAX_WAIT = 300
+# Maximum number of requests in parallel per host and token
+MAX_CONCURRENCY = 32
+# How many of those a single listing uses by default
+DEFAULT_WORKERS = 8
+# Don't tell the user about waits shorter than this
+QUIET_WAIT = 5
+
+budgets = {}
+budgets_lock = threading.Lock()
+
+def header(headers, *names):
+    for name in names:
+        if name in headers:
+            return headers[name]
+
+def integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def retry_after(response):
+    """The Retry-After header as a timestamp, or None"""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    seconds = integer(value)
+    if seconds is not None:
+        return time.time() + seconds
+    # Imports socket, which is not needed by commands that don't log in
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    return date and email.utils.mktime_tz(date)
+
+def is_throttled(response, remaining):
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    if remaining == 0 or 'Retry-After' in response.headers:
+        return True
+    # GitHub's secondary rate limits only say so in the message
+    try:
+        message = response.text.lower()
+    except Exception:
+        return False
+    return 'rate limit' in message or 'abuse' in message
+
+class Budget(object):
+    """The rate limit budget of a single token on a single host"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit = self.remaining = self.reset = None
+        self.blocked_until = 0
+        self.next_request = 0
+        self.interval = 0
+        self.backoff = DEFAULT_BACKOFF
+        self.concurrency = float(MAX_CONCURRENCY)
+
+    def workers(self, maximum=DEFAULT_WORKERS):
+        """How many requests should be done in parallel"""
+        return max(1, min(maximum, int(self.concurrency)))
+
+    def wait(self):
+        """Wait until the next request may be sent"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request, self.blocked_until)
+            self.next_request = start + self.interval
+            blocked = self.blocked_until > now
+        delay = start - now
+        if delay <= 0:
+            return
+        stats.add('rate limit waits')
+        if blocked and delay >= QUIET_WAIT:
+            msg = "API rate limit reached, waiting until %s" % time.strftime("%H:%M:%S", time.localtime(start))
+            sys.stderr.write(wrap(msg, fgcolor.red, attr.bright) + '\n')
+        time.sleep(delay)
+
+    def ready_at(self):
+        """When the next request may be sent"""
+        with self.lock:
+            return max(self.next_request, self.blocked_until)
+
+    def update(self, response):
+        """Update the budget from the headers of a response. Returns whether
+           the request was throttled and should be retried"""
+        headers = response.headers
+        now = time.time()
+        limit = integer(header(headers, 'X-RateLimit-Limit', 'RateLimit-Limit'))
+        remaining = integer(header(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining'))
+        reset = integer(header(headers, 'X-RateLimit-Reset', 'RateLimit-Reset'))
+        throttled = is_throttled(response, remaining)
+        with self.lock:
+            if remaining is not None:
+                self.limit, self.remaining, self.reset = limit, remaining, reset
+                if remaining > 0 and reset and limit and remaining < limit * PACE_FRACTION:
+                    self.interval = max(0, reset - now) / float(remaining)
+                else:
+                    self.interval = 0
+                if remaining == 0 and reset:
+                    self.blocked_until = max(self.blocked_until, reset + 1)
+            if throttled:
+                until = retry_after(response)
+                if until is None and remaining == 0 and reset:
+                    until = reset + 1
+                if until is None:
+                    until = now + self.backoff
+                    self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                self.blocked_until = max(self.blocked_until, until)
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                self.backoff = DEFAULT_BACKOFF
+                self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1 / self.concurrency)
+        return throttled
+
+def resource(url):
+    """The rate limit a request to url is expected to count against"""
+    if url.split('?', 1)[0].rstrip('/').endswith('/graphql'):
+        return 'graphql'
+    return 'core'
+
+def budget(url, credentials, resource_=None):
+    """The budget for the host of url, the given credentials and a resource,
+       by default the one for url"""
+    scheme, _, rest = url.partition('://')
+    key = (scheme, rest.split('/', 1)[0], repr(credentials), resource_ or resource(url))
+    with budgets_lock:
+        if key not in budgets:
+            budgets[key] = Budget()
+        return budgets[key]
+
+def request(send, credentials, method, url, *args, **kwargs):
+    """Do a request with send(method, url, ...), waiting for the rate limit
+       budget of the credentials and retrying throttled idempotent requests"""
+    budget_ = budget(url, credentials)
+    retries = 0
+    give_up = None
+    while True:
+        budget_.wait()
+        response = send(method, url, *args, **kwargs)
+        if 'X-RateLimit-Resource' in response.headers:
+            budget_ = budget(url, credentials, response.headers['X-RateLimit-Resource'])
+        if not budget_.update(response) or method.upper() not in IDEMPOTENT or retries == MAX_RETRIES:
+            return response
+        give_up = give_up or time.time() + MAX_WAIT
+        if budget_.ready_at() > give_up:
+            return response
+        retries += 1
+        stats.add('rate limit retries')
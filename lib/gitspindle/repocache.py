@@ -0,0 +1,195 @@
+# Remembering which repositories on the service a local repository belongs to
+#
+# Most commands start by looking up the repository that the remotes of the
+# current repository point to, and --parent and --root walk up the forks with
+# another request per step. The answers rarely change, so they are stored in
+# the git dir, together with the attributes most commands need: names, ids,
+# urls, the default branch and visibility. A repository found in the cache is
+# represented by a Repository object that answers from those attributes, and
+# only fetches the full repository when something else is needed. Methods,
+# such as the ones listing issues, are called on an object the API client
+# builds from the cached attributes, as they need little more than an id or
+# a name.
+#
+# Entries are used for TTL seconds. The --refresh option ignores them, and a
+# cached repository that can no longer be fetched is forgotten. Offline, they
+# are used no matter how old they are, and nothing is stored.
+
+from gitspindle import stats
+from gitspindle.gitconfig import replace
+import gitspindle.offline as offline
+import json
+import os
+import tempfile
+import threading
+import time
+
+# How long cached repository metadata is used, in seconds
+TTL = 3600
+# Where in the git dir it is stored
+FILENAME = 'spindle-repositories.json'
+
+class Attributes(dict):
+    """A dict of cached attributes, whose items can also be read as
+       attributes. Anything that is not cached is looked up in the full
+       object, returned by fetch"""
+    def __init__(self, items, fetch):
+        super(Attributes, self).__init__((key, wrap(value, lambda key=key: fetch()[key])) for (key, value) in items.items())
+        self._fetch = fetch
+
+    def __missing__(self, key):
+        return self._fetch()[key]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in self:
+            return self[name]
+        return getattr(self._fetch(), name)
+
+def wrap(value, fetch):
+    if isinstance(value, dict):
+        return Attributes(value, fetch)
+    return value
+
+class Repository(object):
+    """A repository known from its cached attributes. Methods are looked up
+       on lean, an API object made from those attributes. The full repository
+       is fetched when anything else is used"""
+    def __init__(self, name, attributes, fetch, lean=None):
+        self.__dict__['_cache_name'] = name
+        self.__dict__['_cache_attributes'] = attributes
+        self.__dict__['_fetch'] = fetch
+        self.__dict__['_lean'] = lean
+        self.__dict__['_full'] = None
+        self.__dict__['_assigned'] = {}
+        for key, value in attributes.items():
+            self.__dict__[key] = wrap(value, lambda key=key: getattr(self._repository(), key))
+
+    def _repository(self):
+        if self._full is None:
+            full = self._fetch()
+            for key, value in self._assigned.items():
+                setattr(full, key, value)
+            self.__dict__['_full'] = full
+        return self._full
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._full is None and self._lean is not None and callable(getattr(type(self._lean), name, None)):
+            return getattr(self._lean, name)
+        return getattr(self._repository(), name)
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        self._assigned[name] = value
+        for repo in (self._lean, self._full):
+            if repo is not None:
+                setattr(repo, name, value)
+
+    def __repr__(self):
+        return '<Cached repository %s>' % self._cache_name
+
+class Cache(object):
+    """The repositories an account sees for one local repository"""
+    def __init__(self, git_dir, account, ttl=TTL):
+        self.file = os.path.join(git_dir, FILENAME)
+        self.account = account
+        self.ttl = ttl
+        self.data = None
+        self.lock = threading.RLock()
+
+    def entries(self):
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.file) as fd:
+                        self.data = json.load(fd)
+                except (IOError, OSError, ValueError):
+                    self.data = {}
+            return self.data.setdefault(self.account, {'lookups': {}, 'repositories': {}})
+
+    def fresh(self, entry):
+        if entry is not None and offline.is_offline():
+            return True
+        return entry is not None and 0 <= time.time() - entry['fetched-at'] < self.ttl
+
+    def lookup(self, key):
+        """The name and attributes of the repository that key was resolved
+           to, or None"""
+        entries = self.entries()
+        name = entries['lookups'].get(key)
+        entry = entries['repositories'].get(name)
+        if not self.fresh(entry):
+            return None
+        stats.add('cached repositories used')
+        offline.used(entry['fetched-at'])
+        return name, entry['attributes']
+
+    def parent(self, name):
+        """Whether the parent of a repository is known, and if so the name and
+           attributes of the parent, or None if it is not a fork"""
+        entries = self.entries()
+        entry = entries['repositories'].get(name)
+        if not self.fresh(entry) or 'parent' not in entry:
+            return False, None
+        if entry['parent'] is None:
+            return True, None
+        parent = entries['repositories'].get(entry['parent'])
+        if not self.fresh(parent):
+            return False, None
+        stats.add('cached repositories used')
+        offline.used(parent['fetched-at'])
+        return True, (entry['parent'], parent['attributes'])
+
+    def add(self, name, attributes, key=None):
+        """Remember a repository, and that key resolves to it"""
+        with self.lock:
+            self.store(name, attributes, key)
+            self.save()
+
+    def add_parent(self, name, parent):
+        """Remember the parent of a repository, given as name and attributes,
+           or None if it is not a fork"""
+        with self.lock:
+            entry = self.entries()['repositories'].get(name)
+            if not entry:
+                return
+            if parent:
+                self.store(*parent)
+            entry['parent'] = parent and parent[0]
+            self.save()
+
+    def store(self, name, attributes, key=None):
+        entries = self.entries()
+        entry = {'fetched-at': time.time(), 'attributes': attributes}
+        old = entries['repositories'].get(name)
+        if self.fresh(old) and 'parent' in old:
+            entry['parent'] = old['parent']
+        entries['repositories'][name] = entry
+        if key:
+            entries['lookups'][key] = name
+
+    def forget(self, name):
+        """Forget a repository, for example because it no longer exists"""
+        with self.lock:
+            entries = self.entries()
+            entries['repositories'].pop(name, None)
+            for key, value in list(entries['lookups'].items()):
+                if value == name:
+                    del entries['lookups'][key]
+            self.save()
+
+    def save(self):
+        if offline.is_offline():
+            # What we learned offline came from caches too
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.file))
+            with os.fdopen(fd, 'w') as fd:
+                json.dump(self.data, fd)
+            replace(tmp, self.file)
+        except (IOError, OSError):
+            # A cache that can't be written is not a reason to fail
+            pass
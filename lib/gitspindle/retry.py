@@ -0,0 +1,102 @@
+# Surviving flaky servers
+#
+# Requests that can safely be repeated (GET and HEAD) are retried when the
+# connection fails or the server answers with a 5xx error, waiting a random
+# time between retries that grows exponentially. When a host keeps failing,
+# its circuit breaker opens and further requests fail immediately for a
+# while, instead of each of them going through all retries.
+
+from gitspindle import stats, GitSpindleError
+import random
+import threading
+import time
+
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS')
+RETRY_STATUS = (500, 502, 503, 504)
+RETRIES = 4
+# Seconds to wait before the first retry, and at most
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+# Consecutive failures after which the circuit breaker opens, and how long
+# it stays open before requests are tried again
+FAILURE_THRESHOLD = 8
+COOLDOWN = 30
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+class CircuitOpenError(GitSpindleError):
+    pass
+
+def delay(attempt):
+    """Full jitter: a random wait up to the exponential backoff"""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+class Breaker(object):
+    """The circuit breaker for a single host"""
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        with self.lock:
+            if self.opened is not None and time.time() < self.opened + COOLDOWN:
+                raise CircuitOpenError("%s is not responding, try again later" % self.host)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= FAILURE_THRESHOLD:
+                if self.opened is None:
+                    stats.add('circuit breaker trips')
+                # Also when a trial request after the cooldown fails
+                self.opened = time.time()
+
+def breaker(url):
+    """The circuit breaker for the host of url"""
+    host = url.partition('://')[2].split('/', 1)[0]
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = Breaker(host)
+        return breakers[host]
+
+def request(send, method, url, *args, **kwargs):
+    """Do a request with send(method, url, ...), retrying idempotent requests
+       on connection errors and server errors. A retries argument overrides
+       how often"""
+    import requests
+    breaker_ = breaker(url)
+    retries = kwargs.pop('retries', None)
+    if retries is None:
+        retries = RETRIES
+    if method.upper() not in IDEMPOTENT:
+        retries = 0
+    attempt = 0
+    while True:
+        breaker_.check()
+        try:
+            response = send(method, url, *args, **kwargs)
+        except requests.exceptions.SSLError:
+            # Retrying does not fix certificates
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker_.failure()
+            if attempt >= retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS:
+                breaker_.success()
+                return response
+            breaker_.failure()
+            if attempt >= retries:
+                return response
+        attempt += 1
+        stats.add('http retries')
+        time.sleep(delay(attempt))
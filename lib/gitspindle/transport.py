@@ -0,0 +1,133 @@
+# Shared HTTP transport for the API clients
+#
+# All requests to a host go through one requests.Session, so connections
+# (and their TLS handshakes) are reused across requests and API objects.
+# Clients attach their own authentication to each request, so accounts on
+# the same host can share the connection pool. Rate limits are tracked per
+# account though, see gitspindle.ratelimit. Failed requests are retried as
+# described in gitspindle.retry, and responses are reused as described in
+# gitspindle.memo and gitspindle.httpcache.
+
+from gitspindle import stats
+import functools
+import threading
+import gitspindle.httpcache as httpcache
+import gitspindle.memo as memo
+import gitspindle.ratelimit as ratelimit
+import gitspindle.retry as retry
+
+# Seconds to wait for a connection and for data, also used for GitHub
+DEFAULT_TIMEOUT = (10, 60)
+# Maximum number of kept-alive connections per host, enough for all requests
+# that may be done in parallel
+POOL_SIZE = ratelimit.MAX_CONCURRENCY
+# Request headers that identify the account
+AUTH_HEADERS = ('Authorization', 'PRIVATE-TOKEN')
+
+transports = {}
+transports_lock = threading.Lock()
+
+class Transport(object):
+    """A pooled session for a single host"""
+    def __init__(self, root, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE):
+        import requests
+        import requests.adapters
+        self.root = root
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(root, self.adapter)
+        # Connections opened by warm_up and by requests that were counted
+        self.lock = threading.Lock()
+        self.warm = self.counted = 0
+
+    def connections(self):
+        """The number of connections opened so far"""
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def share(self, session):
+        """Make another requests session use our connection pool"""
+        session.mount(self.root, self.adapter)
+
+    def warm_up(self, verify=True):
+        """Connect in the background, so the first request does not have to
+           wait for DNS lookups and handshakes"""
+        thread = threading.Thread(target=self.connect, args=(verify,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def connect(self, verify=True):
+        """Open a connection with a HEAD request for the root, which leaves it
+           in the pool for the next request"""
+        try:
+            self.session.head(self.root, verify=verify, timeout=self.timeout, allow_redirects=False)
+            with self.lock:
+                self.warm += 1
+            stats.add('warm connections')
+        except Exception:
+            # It's only a head start, the first request will report problems.
+            # Also when python shuts down while we are still connecting.
+            pass
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        send = functools.partial(httpcache.request, self.send)
+        return memo.request(send, method, url, credentials=self.credentials(kwargs), **kwargs)
+
+    def send(self, method, url, **kwargs):
+        return ratelimit.request(self.send_with_retries, self.credentials(kwargs), method, url, **kwargs)
+
+    def send_with_retries(self, method, url, **kwargs):
+        return retry.request(self.send_once, method, url, **kwargs)
+
+    def credentials(self, kwargs):
+        headers = kwargs.get('headers') or {}
+        return [kwargs.get('auth')] + [headers.get(name) for name in AUTH_HEADERS]
+
+    def budget(self, **kwargs):
+        """The rate limit budget for requests with these arguments"""
+        return ratelimit.budget(self.root, self.credentials(kwargs))
+
+    def send_once(self, method, url, **kwargs):
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            stats.add('http requests')
+            self.count_connections()
+
+    def count_connections(self):
+        """Count the connections requests opened since the last time. With
+           requests in parallel, one request can't tell which connections it
+           opened itself"""
+        with self.lock:
+            new = self.connections() - self.warm - self.counted
+            self.counted += new
+        stats.add('http connections', new)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+def root(url):
+    """The url of the root of the host of url"""
+    scheme, _, rest = url.partition('://')
+    return '%s://%s/' % (scheme, rest.split('/', 1)[0])
+
+def get(url):
+    """The shared transport for the host of url"""
+    root_ = root(url)
+    with transports_lock:
+        if root_ not in transports:
+            transports[root_] = Transport(root_)
+        return transports[root_]
@@ -15,6 +15,22 @@ test_expect_success "Testing config unsetting" "
     git_hub_1 config --unset level &&
     test -z \"\$(git_hub_1 config level)\"
 "
+test_expect_success "Setting an unchanged value does not write the config file" "
+    git_hub_1 config level over_9000 &&
+    GITSPINDLE_STATS=1 git_hub_1 config level over_9000 2>stats &&
+    ! grep 'config files written' stats &&
+    git_hub_1 config --unset level
+"
+test_expect_success "Parallel config changes do not fail on the lock" "
+    for i in 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20; do
+        git_hub_1 config parallel-\$i \$i & pids=\"\$pids \$!\"
+    done &&
+    for pid in \$pids; do wait \$pid || return 1; done &&
+    for i in 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20; do
+        test \$(git_hub_1 config parallel-\$i) = \$i &&
+        git_hub_1 config --unset parallel-\$i || return 1
+    done
+"
 
 test_done
 
@@ -0,0 +1,23 @@
+#!/bin/sh
+
+test_description="Testing the startup cost of commands that do not log in"
+
+. ./setup.sh
+
+"$PYTHON" -X importtime -c pass 2>/dev/null && test_set_prereq importtime
+
+for spindle in hub lab bb; do
+    test_expect_success importtime "No-login commands do not import the API libraries ($spindle)" "
+        \"\$PYTHON\" -X importtime \"\$SHARNESS_BUILD_DIRECTORY/bin/git-$spindle\" help help 2>importtime.$spindle >/dev/null &&
+        \"\$PYTHON\" -X importtime \"\$SHARNESS_BUILD_DIRECTORY/bin/git-$spindle\" config user 2>>importtime.$spindle >/dev/null &&
+        ! grep -E ' (github3|requests|webbrowser|socket)\$' importtime.$spindle
+    "
+
+    test_expect_success importtime "Importing the $spindle backend stays within budget" "
+        awk -F'|' '\$3 ~ / gitspindle\\.(github|gitlab|bitbucket)\$/ { if (\$2 > 150000) exit 1 }' importtime.$spindle
+    "
+done
+
+test_done
+
+# vim: set syntax=sh:
@@ -11,6 +11,24 @@ for spindle in hub lab bb; do
     test_expect_success $spindle "whois shows the expected user ($spindle)" "
         git_${spindle}_1  whois $(username git_${spindle}_2) | grep -q '^Profile.*/$(username git_${spindle}_2)'
     "
+    test_expect_success $spindle "Responses are not stored without opting in ($spindle)" "
+        rm -rf \"\${XDG_CACHE_HOME:-\$HOME/.cache}/git-spindle/http\" &&
+        git_${spindle}_1 whoami > /dev/null &&
+        test ! -d \"\${XDG_CACHE_HOME:-\$HOME/.cache}/git-spindle/http\"
+    "
+    test_expect_success $spindle "whoami works offline after it worked online ($spindle)" "
+        git config --global gitspindle.cache-authenticated-responses true &&
+        git_${spindle}_1 whoami > /dev/null &&
+        git_${spindle}_1 --offline whoami > whoami 2> stale &&
+        git config --global --unset gitspindle.cache-authenticated-responses &&
+        grep -q '^Profile.*/$(username git_${spindle}_1)' whoami &&
+        grep -q '^Working offline' stale
+    "
+    test_expect_success $spindle "Nothing can be changed offline ($spindle)" "
+        echo 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQ offline-test' > offline.pub &&
+        test_must_fail git_${spindle}_1 --offline add-public-keys offline.pub 2> error &&
+        grep -q 'offline' error
+    "
 done
 
 test_done
@@ -27,6 +27,15 @@ EOF
         git_${spindle}_1 browse issues >>actual &&
         test_cmp expected actual)
     "
+    test_expect_success $spindle "Repository metadata is cached ($spindle)" "
+        (cd whelk &&
+        test -f .git/spindle-repositories.json &&
+        echo https://$(spindle_host git_${spindle}_1)/seveas/whelk > expected &&
+        git_${spindle}_1 browse >actual &&
+        git_${spindle}_1 --refresh browse >>actual &&
+        echo https://$(spindle_host git_${spindle}_1)/seveas/whelk >> expected &&
+        test_cmp expected actual)
+    "
 done
 
 test_done
@@ -271,6 +271,27 @@ for spindle in lab hub bb; do
             ;;
     esac
 
+    test_expect_success $spindle "List issues from the local index ($spindle)" "
+        git_${spindle}_1 sync whelk &&
+        git_${spindle}_1 issues --cached whelk > issues &&
+        grep -q 'Test issue (outside) $id' issues &&
+        grep -q 'Test issue (inside) $id' issues
+    "
+
+    test_expect_success $spindle "Syncing again updates the local index ($spindle)" "
+        git_${spindle}_1 --refresh sync whelk &&
+        git_${spindle}_1 issues --cached whelk > issues &&
+        test \$(grep -c 'Test issue (outside) $id' issues) = 1 &&
+        git_${spindle}_1 issues --search 'outside $id' > issues &&
+        test \$(grep -c 'Test issue (outside) $id' issues) = 1
+    "
+
+    test_expect_success $spindle "Search issues in the local index ($spindle)" "
+        git_${spindle}_1 issues --search 'outside $id' > issues &&
+        grep -q 'Test issue (outside) $id' issues &&
+        ! grep -q 'Test issue (inside) $id' issues
+    "
+
     test_expect_failure $spindle "Display single issue" "false"
 done
 
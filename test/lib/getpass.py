@@ -1,2 +1,2 @@
 # unsafe getpass to allow tests to prompt for passwords
-getpass = raw_input
+from gitspindle import raw_input as getpass
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Benchmark for doing many API requests at once with gitspindle.bulk, like
+# the bulk commands do. Starts a local HTTP server that answers every request
+# after a fixed latency, and times fetching the same number of distinct urls
+# with 1, 8 and 32 requests in flight.
+#
+# Usage: api_concurrency.py [--requests=<n>] [--latency=<seconds>]
+#
+# The requests go through the shared transport, so connection reuse, rate
+# limit accounting and retries are part of what is measured.
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib'))
+import gitspindle
+import gitspindle.bulk as bulk
+import gitspindle.transport as transport
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one go, or delayed ACKs add 40ms per request
+    wbufsize = 65536
+    latency = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = ('{"url": "%s"}' % self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', '5000')
+        self.send_header('X-RateLimit-Remaining', '4999')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def run(root, requests, concurrency, run_id):
+    conn = transport.get(root)
+    urls = ['%sbench/%d/%d' % (root, run_id, num) for num in range(requests)]
+    gitspindle.stats.clear()
+    start = time.time()
+    for response in bulk.map(conn.get, urls, root, conn.budget(), concurrency):
+        if response.status_code != 200:
+            raise RuntimeError("Request failed: %d" % response.status_code)
+    return time.time() - start, gitspindle.stats['http connections']
+
+def main():
+    requests = 256
+    latency = 0.05
+    for arg in sys.argv[1:]:
+        if arg.startswith('--requests='):
+            requests = int(arg[11:])
+        elif arg.startswith('--latency='):
+            latency = float(arg[10:])
+        else:
+            sys.stderr.write("Usage: %s [--requests=<n>] [--latency=<seconds>]\n" % sys.argv[0])
+            sys.exit(1)
+
+    Handler.latency = latency
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    root = 'http://127.0.0.1:%d/' % server.server_address[1]
+    try:
+        for run_id, concurrency in enumerate((1, 8, 32)):
+            elapsed, connections = run(root, requests, concurrency, run_id)
+            print("%d requests with %d in flight: %.2fs, %.1f requests/s, %d new connections" %
+                  (requests, concurrency, elapsed, requests / elapsed, connections))
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
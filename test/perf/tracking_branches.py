@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Benchmark for GitSpindle.set_tracking_branches on a repository with many
+# branches. Creates a scratch repository with the requested number of local
+# branches, a matching remote-tracking branch for most of them, and then
+# times setting up tracking branches.
+#
+# Usage: tracking_branches.py [--branches=<n>] [--compare]
+#
+# With --compare, the old implementation (which ran for-each-ref and git
+# config for every branch) is timed as well, on a second copy of the
+# repository, and the resulting configs are checked to be identical.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib'))
+import gitspindle
+from gitspindle.gitlab import GitLab
+
+def git(*args, **kwargs):
+    return subprocess.check_output(('git',) + args, **kwargs).decode('utf-8')
+
+def make_repo(path, branches):
+    git('init', '-q', path)
+    os.chdir(path)
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com')
+    git('commit', '-q', '--allow-empty', '-m', 'Benchmark', env=env)
+    head = git('rev-parse', 'HEAD').strip()
+    commands = []
+    for num in range(branches):
+        commands.append('create refs/heads/branch-%05d %s\n' % (num, head))
+        if num % 10:
+            commands.append('create refs/remotes/origin/branch-%05d %s\n' % (num, head))
+        if num % 3 == 0:
+            commands.append('create refs/remotes/upstream/branch-%05d %s\n' % (num, head))
+    proc = subprocess.Popen(['git', 'update-ref', '--stdin'], stdin=subprocess.PIPE)
+    proc.communicate(''.join(commands).encode('utf-8'))
+    git('pack-refs', '--all')
+
+def old_set_tracking_branches(self, remote, upstream=None, triangular=False, upstream_branch=None):
+    if triangular and upstream:
+        pushremote = remote
+        pullremote = upstream
+        self.gitm('config', 'remote.pushDefault', pushremote)
+    else:
+        pushremote = None
+        pullremote = remote
+        upstream_branch = None
+
+    for branch in self.git('for-each-ref', 'refs/heads/**').stdout.strip().splitlines():
+        branch = branch.split(None, 2)[-1][11:]
+
+        if upstream_branch and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, upstream_branch)).stdout.strip():
+            tracking_remote = pullremote
+            tracking_branch = upstream_branch
+        elif self.git('for-each-ref', 'refs/remotes/%s/%s' % (pullremote, branch)).stdout.strip():
+            tracking_remote = pullremote
+            tracking_branch = branch
+        elif pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
+            tracking_remote = pushremote
+            tracking_branch = branch
+        else:
+            tracking_remote = None
+            tracking_branch = None
+
+        if tracking_remote and tracking_branch:
+            current = self.git('config', 'branch.%s.remote' % branch).stdout.strip()
+            if current in [remote, upstream, '']:
+                print("Configuring branch %s to track branch %s on remote %s" % (branch, tracking_branch, tracking_remote))
+                self.gitm('config', 'branch.%s.remote' % branch, tracking_remote)
+                self.gitm('config', 'branch.%s.merge' % branch, 'refs/heads/%s' % tracking_branch)
+
+        if pushremote and self.git('for-each-ref', 'refs/remotes/%s/%s' % (pushremote, branch)).stdout.strip():
+            current = self.git('config', 'branch.%s.pushremote' % branch).stdout.strip()
+            if current in [remote, upstream, '']:
+                print("Configuring branch %s to push to remote %s" % (branch, pushremote))
+                self.gitm('config', 'branch.%s.pushremote' % branch, pushremote)
+
+def run(path, implementation):
+    os.chdir(path)
+    spindle = GitLab()
+    gitspindle.stats.clear()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.time()
+    try:
+        implementation(spindle, 'origin', upstream='upstream', triangular=True)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return time.time() - start, gitspindle.stats['git processes']
+
+def main():
+    branches = 10000
+    compare = False
+    for arg in sys.argv[1:]:
+        if arg.startswith('--branches='):
+            branches = int(arg[11:])
+        elif arg == '--compare':
+            compare = True
+        else:
+            sys.stderr.write("Usage: %s [--branches=<n>] [--compare]\n" % sys.argv[0])
+            sys.exit(1)
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        new = os.path.join(tmpdir, 'new')
+        make_repo(new, branches)
+        elapsed, processes = run(new, GitLab.set_tracking_branches)
+        print("set_tracking_branches with %d branches: %.2fs, %d git processes" % (branches, elapsed, processes))
+
+        if compare:
+            old = os.path.join(tmpdir, 'old')
+            make_repo(old, branches)
+            elapsed, processes = run(old, old_set_tracking_branches)
+            print("old implementation with %d branches: %.2fs, %d git processes" % (branches, elapsed, processes))
+            configs = [git('config', '--file', os.path.join(path, '.git', 'config'), '--list') for path in (new, old)]
+            if sorted(configs[0].splitlines()) != sorted(configs[1].splitlines()):
+                print("Resulting configs differ!")
+                sys.exit(1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()